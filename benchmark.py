@@ -0,0 +1,467 @@
+#Copyright © Amazon.com and Affiliates: This deliverable is considered Developed Content as defined in the AWS Service Terms and the SOW between the parties dated 15 Nov 2024.
+"""Offline benchmark of the update function.
+
+Runs index.lambda_handler against in-memory stand-ins for S3, Secrets Manager,
+bedrock-agent and bedrock-agent-runtime, on synthetic feeds of any size, and
+reports the wall time, peak RSS and AWS calls of each pipeline stage. Each
+scenario runs in a fresh process, so peak RSS and the module caches are not
+shared between scenarios.
+
+    python benchmark.py --items 100,1000,10000 --concurrency 1,4,8
+    python benchmark.py --items 100000 --bedrock-latency-ms 800 --throttle-rate 0.1
+
+With a throttle rate, the run fails unless every throttled invocation was
+counted and retried by the function.
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from xml.sax import saxutils
+from botocore.exceptions import ClientError
+
+BUCKET_NAME = 'awsnews-benchmark'
+SECRET_NAME = 'benchmark-feed-url-secret'
+SERVICES = ['AWS Lambda', 'Amazon S3', 'Amazon ECS', 'Amazon RDS', 'AWS WAF', 'Amazon Bedrock', 'Amazon Cognito', 'Amazon API Gateway', 'Amazon EC2', 'Amazon SageMaker', 'AWS Glue', 'Amazon Redshift', 'Amazon Connect', 'AWS IoT Core', 'Amazon Aurora', 'AWS Systems Manager']
+WORDS = ('support region launch customer instance feature console metric quota policy network storage cluster pipeline model '
+         'dataset endpoint encryption replica snapshot workflow dashboard integration capacity latency throughput version '
+         'runtime template notebook partition schema gateway audit identity key secret queue topic stream event alarm').split()
+
+# Synthetic data
+
+def synthetic_item(number, published, rng):
+    service = rng.choice(SERVICES)
+    title = f"{service} now supports {' '.join(rng.sample(WORDS, 3))} ({number})"
+    description = f"{service} {' '.join(rng.choice(WORDS) for _ in range(60))}."
+    link = f"https://aws.amazon.com/about-aws/whats-new/{published:%Y/%m}/synthetic-{number}/"
+    return (
+        f"<item><guid isPermaLink=\"false\">{hashlib.sha1(link.encode('utf-8')).hexdigest()}</guid>"
+        f"<title>{saxutils.escape(title)}</title><link>{link}</link>"
+        f"<description>{saxutils.escape(description)}</description>"
+        f"<pubDate>{format_datetime(published, usegmt=True)}</pubDate></item>\n"
+    )
+
+def write_feed(path, items):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel><title>Synthetic announcements</title>'
+                '<link>https://aws.amazon.com/about-aws/whats-new/recent/</link><description>Benchmark feed</description>\n')
+        f.writelines(items)
+        f.write('</channel></rss>\n')
+
+def generate_data(directory, items, new_items, seed=0):
+    """Write an upstream feed of items entries, all but the newest new_items of which are already in processed.xml."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    feed = [synthetic_item(number, now - timedelta(minutes=10 * number), rng) for number in range(items)]
+    upstream, processed = os.path.join(directory, f"feed-{items}.xml"), os.path.join(directory, f"processed-{items}.xml")
+    write_feed(upstream, feed)
+    write_feed(processed, feed[new_items:])
+    return {'upstream': upstream, 'processed': processed}
+
+# AWS stand-ins
+
+class CallCounter:
+    """Count stand-in calls per pipeline stage, taking the stage from index.timed_stage, and the counters of index.add_metric."""
+
+    def __init__(self):
+        self.counts = {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stage(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else 'Other'
+
+    def count(self, service, operation):
+        key = (self.stage(), service, operation)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def track(self, timed_stage):
+        @contextlib.contextmanager
+        def tracked_stage(stage):
+            stack = self.local.__dict__.setdefault('stack', [])
+            stack.append(stage)
+            try:
+                with timed_stage(stage):
+                    yield
+            finally:
+                stack.pop()
+        return tracked_stage
+
+    def track_metrics(self, add_metric):
+        # Kept across the worker and aggregator invocations of a run, which reset index._metrics
+        def tracked_metric(name, *args, **kwargs):
+            # Forwarded as called, so a call index.add_metric rejects still fails
+            add_metric(name, *args, **kwargs)
+            value = args[0] if args else kwargs.get('value', 1)
+            with self.lock:
+                self.metrics[name] = self.metrics.get(name, 0) + value
+        return tracked_metric
+
+class StandIn:
+    """Base of the stand-in clients: counts calls and applies the simulated latency."""
+
+    service = None
+
+    def __init__(self, counter, latency_ms):
+        self.counter = counter
+        self.latency = latency_ms / 1000
+
+    def call(self, operation):
+        self.counter.count(self.service, operation)
+        if self.latency:
+            time.sleep(self.latency)
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class S3Body(io.BytesIO):
+    def iter_lines(self):
+        for line in self:
+            yield line.rstrip(b'\r\n')
+
+class S3StandIn(StandIn):
+    """In-memory bucket with ETags and conditional writes."""
+
+    service = 's3'
+
+    def __init__(self, counter, latency_ms):
+        super().__init__(counter, latency_ms)
+        self.objects = {}
+        self.metadata = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def etag(content):
+        return f'"{hashlib.md5(content).hexdigest()}"'
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.call('GetObject')
+        with self.lock:
+            content = self.objects.get(Key)
+        if content is None:
+            raise client_error('NoSuchKey', 'GetObject')
+        return {'Body': S3Body(content), 'ETag': self.etag(content), 'ContentLength': len(content), 'LastModified': datetime.now(timezone.utc)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.call('HeadObject')
+        with self.lock:
+            content = self.objects.get(Key)
+            metadata = self.metadata.get(Key, {})
+        if content is None:
+            raise client_error('404', 'HeadObject')
+        return {'ETag': self.etag(content), 'ContentLength': len(content), 'Metadata': dict(metadata)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        self.call('PutObject')
+        content = Body.encode('utf-8') if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+        with self.lock:
+            current = self.objects.get(Key)
+            if (IfNoneMatch == '*' and current is not None) or (IfMatch is not None and (current is None or self.etag(current) != IfMatch)):
+                raise client_error('PreconditionFailed', 'PutObject')
+            self.objects[Key] = content
+            self.metadata[Key] = dict(Metadata or {})
+        return {'ETag': self.etag(content)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.call('DeleteObject')
+        with self.lock:
+            self.objects.pop(Key, None)
+            self.metadata.pop(Key, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self.call('ListObjectsV2')
+        with self.lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'LastModified': datetime.now(timezone.utc)} for key in keys], 'IsTruncated': False}
+
+class SecretsManagerStandIn(StandIn):
+    service = 'secretsmanager'
+
+    def __init__(self, counter, latency_ms, secret):
+        super().__init__(counter, latency_ms)
+        self.secret = secret
+
+    def get_secret_value(self, SecretId):
+        self.call('GetSecretValue')
+        return {'SecretString': json.dumps(self.secret)}
+
+class BedrockAgentStandIn(StandIn):
+    """Flows, versions and aliases kept in memory; preparation completes immediately."""
+
+    service = 'bedrock-agent'
+
+    def __init__(self, counter, latency_ms):
+        super().__init__(counter, latency_ms)
+        self.flows = {}
+        self.ids = itertools.count(1)
+
+    def list_flows(self, **kwargs):
+        self.call('ListFlows')
+        return {'flowSummaries': [{'id': flow_id, 'name': flow['name']} for flow_id, flow in self.flows.items()]}
+
+    def create_flow(self, name, description, **kwargs):
+        self.call('CreateFlow')
+        flow_id = f"FLOW{next(self.ids)}"
+        self.flows[flow_id] = {'name': name, 'description': description, 'versions': [], 'aliases': {}}
+        return {'id': flow_id}
+
+    def update_flow(self, flowIdentifier, description, **kwargs):
+        self.call('UpdateFlow')
+        self.flows[flowIdentifier]['description'] = description
+        return {'id': flowIdentifier}
+
+    def prepare_flow(self, flowIdentifier):
+        self.call('PrepareFlow')
+        return {'id': flowIdentifier, 'status': 'Preparing'}
+
+    def get_flow(self, flowIdentifier):
+        self.call('GetFlow')
+        return {'id': flowIdentifier, 'status': 'Prepared'}
+
+    def create_flow_version(self, flowIdentifier, **kwargs):
+        self.call('CreateFlowVersion')
+        versions = self.flows[flowIdentifier]['versions']
+        versions.append(str(len(versions) + 1))
+        return {'version': versions[-1]}
+
+    def list_flow_versions(self, flowIdentifier, **kwargs):
+        self.call('ListFlowVersions')
+        return {'flowVersionSummaries': [{'version': version} for version in self.flows[flowIdentifier]['versions']]}
+
+    def delete_flow_version(self, flowIdentifier, flowVersion):
+        self.call('DeleteFlowVersion')
+        self.flows[flowIdentifier]['versions'].remove(flowVersion)
+
+    def create_flow_alias(self, flowIdentifier, name, description, **kwargs):
+        self.call('CreateFlowAlias')
+        alias_id = f"ALIAS{next(self.ids)}"
+        self.flows[flowIdentifier]['aliases'][alias_id] = {'id': alias_id, 'name': name, 'description': description}
+        return {'id': alias_id}
+
+    def update_flow_alias(self, aliasIdentifier, flowIdentifier, description, **kwargs):
+        self.call('UpdateFlowAlias')
+        self.flows[flowIdentifier]['aliases'][aliasIdentifier]['description'] = description
+        return {'id': aliasIdentifier}
+
+    def list_flow_aliases(self, flowIdentifier, **kwargs):
+        self.call('ListFlowAliases')
+        return {'flowAliasSummaries': list(self.flows[flowIdentifier]['aliases'].values())}
+
+class BedrockAgentRuntimeStandIn(StandIn):
+    """Flow invocations answered by the local backend, throttled at the given rate."""
+
+    service = 'bedrock-agent-runtime'
+
+    class exceptions:
+        class ResourceNotFoundException(ClientError):
+            pass
+
+        class ValidationException(ClientError):
+            pass
+
+        class ThrottlingException(ClientError):
+            pass
+
+    def __init__(self, counter, latency_ms, throttle_rate, answer):
+        super().__init__(counter, latency_ms)
+        self.throttle_rate = throttle_rate
+        self.answer = answer
+        self.rng = random.Random(0)
+        self.throttled = 0
+
+    def invoke_flow(self, flowIdentifier, flowAliasIdentifier, inputs, **kwargs):
+        self.call('InvokeFlow')
+        if self.rng.random() < self.throttle_rate:
+            self.throttled += 1
+            raise self.exceptions.ThrottlingException({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'InvokeFlow')
+        document = self.answer(inputs[0]['content']['document'])
+        return {'responseStream': [
+            {'flowOutputEvent': {'nodeName': 'FlowOutputNode', 'content': {'document': document}}},
+            {'flowCompletionEvent': {'completionReason': 'SUCCESS'}}
+        ]}
+
+# Scenarios
+
+class Context:
+    """Lambda context with a real deadline."""
+
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000
+        self.log_stream_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def run_scenario(scenario):
+    """Run the handler for one scenario in the current (fresh) process and return its measurements."""
+    os.environ.update({
+        'BUCKET_NAME': BUCKET_NAME,
+        'FLOW_EXECUTION_ROLE_ARN': 'arn:aws:iam::123456789012:role/benchmark',
+        'FEED_URL_SECRET_NAME': SECRET_NAME,
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+        'EXECUTION_BACKEND': scenario['backend'],
+        'PIPELINE_MODE': scenario['pipeline'],
+        'QUEUE_SERVICE': 'local',
+        'FLOW_CONCURRENCY': str(scenario['concurrency']),
+        'MAX_ENTRIES_PER_RUN': str(scenario['entries_per_run']),
+        'METRICS_SINK': 'off',
+        'LOG_LEVEL': 'ERROR',
+        'RETRY_BASE_DELAY': str(scenario['retry_base_delay']),
+    })
+    # The function logs go nowhere, so they do not weigh on the measurements
+    log = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(log):
+        import index
+
+    counter = CallCounter()
+    index.timed_stage = counter.track(index.timed_stage)
+    index.add_metric = counter.track_metrics(index.add_metric)
+    s3 = S3StandIn(counter, scenario['s3_latency_ms'])
+    with open(scenario['processed'], 'rb') as f:
+        s3.objects[index.KEY_PROCESSED_NAME] = f.read()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), index.KEY_NAME), 'rb') as f:
+        s3.objects[index.KEY_NAME] = f.read()
+    runtime = BedrockAgentRuntimeStandIn(counter, scenario['bedrock_latency_ms'], scenario['throttle_rate'], lambda document: index.invoke_local_backend({}, None, [document])[0])
+    index._clients.update({
+        's3': s3,
+        'secretsmanager': SecretsManagerStandIn(counter, scenario['s3_latency_ms'], {'FEED_URL': scenario['upstream']}),
+        'bedrock-agent': BedrockAgentStandIn(counter, scenario['bedrock_latency_ms']),
+        'bedrock-agent-runtime': runtime
+    })
+
+    runs = []
+    for _ in range(scenario['runs']):
+        counter.counts.clear()
+        counter.metrics.clear()
+        runtime.throttled = 0
+        started_at = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            response = index.lambda_handler({}, Context(scenario['timeout_ms']))
+        wall_ms = (time.perf_counter() - started_at) * 1000
+        calls = {}
+        for (stage, service, operation), count in counter.counts.items():
+            calls.setdefault(stage, {})[f"{service}:{operation}"] = count
+        runs.append({
+            'wall_ms': round(wall_ms, 1),
+            'stages': {stage: {'ms': round(total_ms, 1), 'calls': count} for stage, (total_ms, count) in index._metrics['stages'].items()},
+            'aws_calls': calls,
+            'throttled': runtime.throttled,
+            'metrics': dict(counter.metrics),
+            'result': json.loads(response['body'])
+        })
+    # ru_maxrss is in kilobytes on Linux
+    return dict(scenario, peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), runs=runs)
+
+def scenario_name(scenario):
+    return f"items={scenario['items']} pipeline={scenario['pipeline']} backend={scenario['backend']} concurrency={scenario['concurrency']} entries_per_run={scenario['entries_per_run']}"
+
+def print_report(result):
+    print(f"\n== {scenario_name(result)}  peak RSS {result['peak_rss_mb']} MB")
+    for number, run in enumerate(result['runs'], 1):
+        print(f"run {number}: {run['wall_ms']:.0f} ms, {run['result']}")
+        stages = sorted(set(run['stages']) | set(run['aws_calls']), key=lambda stage: -run['stages'].get(stage, {}).get('ms', 0))
+        for stage in stages:
+            timing = run['stages'].get(stage, {'ms': 0, 'calls': 0})
+            calls = ', '.join(f"{operation} x{count}" for operation, count in sorted(run['aws_calls'].get(stage, {}).items()))
+            print(f"  {stage:<16}{timing['ms']:>10.1f} ms {timing['calls']:>6} calls  {calls}")
+
+def check_retries(result):
+    """Return the runs whose throttled flow invocations were not counted and retried by the function."""
+    problems = []
+    for number, run in enumerate(result['runs'], 1):
+        metrics = run.get('metrics', {})
+        if metrics.get('ModelThrottles', 0) != run['throttled']:
+            problems.append(f"{scenario_name(result)} run {number}: {run['throttled']} throttled invocations, {metrics.get('ModelThrottles', 0)} counted")
+        elif run['throttled'] and not metrics.get('ModelRetries'):
+            problems.append(f"{scenario_name(result)} run {number}: {run['throttled']} throttled invocations, none retried")
+    return problems
+
+def compare(results, baseline, tolerance):
+    """Return the scenarios whose wall time or peak RSS grew beyond tolerance over the baseline."""
+    previous = {scenario_name(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get(scenario_name(result))
+        if reference is None:
+            continue
+        for label, current, before in [
+            ('wall time', sum(run['wall_ms'] for run in result['runs']), sum(run['wall_ms'] for run in reference['runs'])),
+            ('peak RSS', result['peak_rss_mb'], reference['peak_rss_mb'])
+        ]:
+            if before and current > before * (1 + tolerance):
+                regressions.append(f"{scenario_name(result)}: {label} {before:.1f} -> {current:.1f}")
+    return regressions
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the update function against local AWS stand-ins.')
+    parser.add_argument('--items', type=int_list, default=[100, 1000, 10000], help='upstream feed sizes, comma-separated (default 100,1000,10000)')
+    parser.add_argument('--new-items', type=int, default=100, help='entries of each feed not yet processed (default 100)')
+    parser.add_argument('--concurrency', type=int_list, default=[4], help='FLOW_CONCURRENCY values to compare (default 4)')
+    parser.add_argument('--entries-per-run', type=int_list, default=[50], help='MAX_ENTRIES_PER_RUN values to compare (default 50)')
+    parser.add_argument('--backend', choices=['flow', 'local'], default='flow', help='flow uses the Bedrock stand-ins, local makes no model call (default flow)')
+    parser.add_argument('--pipeline', choices=['batch', 'queue'], default='batch', help='PIPELINE_MODE, queue running the workers and aggregator on local queues (default batch)')
+    parser.add_argument('--runs', type=int, default=1, help='handler invocations per scenario, sharing the bucket (default 1)')
+    parser.add_argument('--s3-latency-ms', type=float, default=0, help='simulated latency of S3 and Secrets Manager calls')
+    parser.add_argument('--bedrock-latency-ms', type=float, default=0, help='simulated latency of Bedrock calls')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='share of flow invocations rejected with ThrottlingException')
+    parser.add_argument('--retry-base-delay', type=float, default=0.05, help='RETRY_BASE_DELAY in seconds (default 0.05)')
+    parser.add_argument('--timeout-ms', type=int, default=300000, help='simulated function timeout (default 300000)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth over the baseline (default 0.2)')
+    args = parser.parse_args()
+
+    results = []
+    problems = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for items in args.items:
+            data = generate_data(directory, items, min(args.new_items, items))
+            for concurrency, entries_per_run in itertools.product(args.concurrency, args.entries_per_run):
+                scenario = dict(data, items=items, backend=args.backend, pipeline=args.pipeline, concurrency=concurrency, entries_per_run=entries_per_run, runs=args.runs,
+                                s3_latency_ms=args.s3_latency_ms, bedrock_latency_ms=args.bedrock_latency_ms, throttle_rate=args.throttle_rate,
+                                retry_base_delay=args.retry_base_delay, timeout_ms=args.timeout_ms)
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_scenario, (scenario,))
+                for key in ('upstream', 'processed'):
+                    result.pop(key)
+                print_report(result)
+                results.append(result)
+                problems += check_retries(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for problem in problems:
+        print(f"Retry check failed: {problem}")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+    if problems or regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
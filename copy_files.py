@@ -1,10 +1,30 @@
 #Copyright © Amazon.com and Affiliates: This deliverable is considered Developed Content as defined in the AWS Service Terms and the SOW between the parties dated 15 Nov 2024.
 import boto3
+import gzip
+import hashlib
 import json
 import urllib.request
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 s3 = boto3.client('s3')
 
+# Files seeded into the bucket, and those the update function keeps writing to
+SEED_FILES = ['awsnews.xml', 'processed.xml', 'testnews.xml']
+LIVE_FEEDS = {'awsnews.xml', 'processed.xml'}
+SEED_HASH_METADATA = 'seed-sha256'
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
+# Same variants and headers as the feeds published by index.py
+FEED_ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+FEED_CONTENT_TYPE = 'application/rss+xml; charset=utf-8'
+FEED_CACHE_CONTROL = 'public, max-age=300, s-maxage=86400'
+ARCHIVE_CACHE_CONTROL = 'public, max-age=86400'
+
 def send_response(event, context, response_status, reason=None, response_data=None, physical_resource_id=None):
     response_body = json.dumps({
         'Status': response_status,
@@ -43,6 +63,86 @@ def send_response(event, context, response_status, reason=None, response_data=No
     except Exception as e:
         print(f"General Exception: Failed to send response1: {str(e)}")
 
+def file_sha256(file_name):
+    """Hash a file in chunks, without reading it into memory."""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_published_feed(key):
+    return key.endswith('.xml') and key != 'processed.xml' and not key.startswith('archive/processed/')
+
+def get_feed_put_args(key):
+    if not is_published_feed(key):
+        return {'ContentType': FEED_CONTENT_TYPE}
+    return {'ContentType': FEED_CONTENT_TYPE, 'CacheControl': ARCHIVE_CACHE_CONTROL if key.startswith('archive/') else FEED_CACHE_CONTROL}
+
+def compress_feed(content, encoding):
+    """Return the body and Content-Encoding of a variant; without brotli the br variant is left uncompressed."""
+    if encoding == 'gzip':
+        return gzip.compress(content, compresslevel=9, mtime=0), 'gzip'
+    if brotli is None:
+        return content, None
+    return brotli.compress(content, mode=brotli.MODE_TEXT, quality=11), 'br'
+
+def publish_variants(dest_bucket, key, encodings, refresh=False):
+    """Write the compressed variants of a published feed, unless they exist already and refresh is not set.
+
+    Feeds written before the variants existed get them here, as CloudFront
+    serves them as soon as the stack is updated.
+    """
+    missing = []
+    for encoding in encodings:
+        try:
+            if not refresh:
+                s3.head_object(Bucket=dest_bucket, Key=key + FEED_ENCODING_SUFFIXES[encoding])
+                continue
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        missing.append(encoding)
+    if not missing:
+        return
+    content = s3.get_object(Bucket=dest_bucket, Key=key)['Body'].read()
+    for encoding in missing:
+        variant, content_encoding = compress_feed(content, encoding)
+        encoding_args = {'ContentEncoding': content_encoding} if content_encoding else {}
+        s3.put_object(Body=variant, Bucket=dest_bucket, Key=key + FEED_ENCODING_SUFFIXES[encoding], **encoding_args, **get_feed_put_args(key))
+    print(f"Published the {', '.join(missing)} variants of {key}")
+
+def list_published_feeds(dest_bucket):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [item['Key'] for page in paginator.paginate(Bucket=dest_bucket) for item in page.get('Contents', []) if is_published_feed(item['Key'])]
+
+def copy_file(dest_bucket, file_name):
+    """Upload a seed file unless the bucket copy matches it or is a live feed written since it was seeded.
+
+    Uploaded objects record the hash of their seed in their metadata. The update
+    function rewrites live feeds without it, so a live feed without the seed hash
+    holds production history and is left alone.
+    """
+    digest = file_sha256(file_name)
+    try:
+        metadata = s3.head_object(Bucket=dest_bucket, Key=file_name).get('Metadata', {})
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        metadata = None
+
+    if metadata is not None and metadata.get(SEED_HASH_METADATA) == digest:
+        print(f"Skipping {file_name}: bucket copy matches the seed")
+        return 'unchanged'
+    if metadata is not None and file_name in LIVE_FEEDS and SEED_HASH_METADATA not in metadata:
+        print(f"Skipping {file_name}: live feed updated since it was seeded")
+        return 'live'
+
+    print(f"Copying file: {file_name}")
+    s3.upload_file(file_name, dest_bucket, file_name, ExtraArgs=dict(get_feed_put_args(file_name), Metadata={SEED_HASH_METADATA: digest}), Config=TRANSFER_CONFIG)
+    print(f"Successfully copied {file_name}")
+    return 'copied'
+
 def lambda_handler(event, context):
     try:
         print("Event received:", event)
@@ -50,20 +150,18 @@ def lambda_handler(event, context):
             dest_bucket = event['ResourceProperties']['DestBucket']
             print(f"Destination bucket: {dest_bucket}")
             
-            # List of files to copy
-            files_to_copy = ['awsnews.xml', 'processed.xml', 'testnews.xml']
-            
-            for file_name in files_to_copy:
-                print(f"Copying file: {file_name}")
-                try:
-                    with open(file_name, 'rb') as file:
-                        s3.put_object(Bucket=dest_bucket, Key=file_name, Body=file.read())
-                    print(f"Successfully copied {file_name}")
-                except Exception as e:
-                    print(f"Error copying {file_name}: {str(e)}")
-                    raise
+            # Upload the seed files in parallel, streamed from disk by the transfer manager
+            with ThreadPoolExecutor(max_workers=len(SEED_FILES)) as executor:
+                results = dict(zip(SEED_FILES, executor.map(lambda file_name: copy_file(dest_bucket, file_name), SEED_FILES)))
             
-            print("All files copied successfully")
+            print(f"All files processed: {results}")
+
+            # Compressed variants of the seeded feeds, and of feeds written before variants existed
+            encodings = [encoding.strip() for encoding in event['ResourceProperties'].get('FeedEncodings', 'br,gzip').split(',') if encoding.strip()]
+            if 'br' in encodings and brotli is None:
+                print("Warning: the brotli module is not installed, the br variants of the feeds are written uncompressed")
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda key: publish_variants(dest_bucket, key, encodings, refresh=results.get(key) == 'copied'), list_published_feeds(dest_bucket)))
         
         send_response(event, context, 'SUCCESS')
     except Exception as e:
@@ -14,6 +14,9 @@ mkdir -p python/lib/python3.12/site-packages
 # Copy the installed packages to our layer directory
 cp -r venv/lib/python3.12/site-packages/* python/lib/python3.12/site-packages/
 
+# Compiled packages are installed as wheels built for the Lambda runtime, whatever the build host
+pip install -r requirements-binary.txt --platform manylinux2014_x86_64 --implementation cp --python-version 3.12 --only-binary=:all: --target python/lib/python3.12/site-packages --upgrade
+
 # Create the zip file
 zip -r ../feedparser-layer.zip python
 
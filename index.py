@@ -1,16 +1,52 @@
 #Copyright © Amazon.com and Affiliates: This deliverable is considered Developed Content as defined in the AWS Service Terms and the SOW between the parties dated 15 Nov 2024.
+import time
+_INIT_STARTED_AT = time.perf_counter()
 import json
 import boto3
 import base64
 from botocore.exceptions import ClientError
 import botocore
-import random, time  # Add this import for random number generation
+from botocore.config import Config
+import random  # Add this import for random number generation
 import feedparser
-from datetime import datetime
-import pytz
+from datetime import datetime, timedelta, timezone
 import PyRSS2Gen
 import os
+import sys
+import logging
 import secrets
+import calendar
+import functools
+import gzip
+import urllib.error
+import urllib.request
+import threading
+import hashlib
+import bisect
+import heapq
+import itertools
+from array import array
+import io
+import re
+from email.utils import format_datetime, parsedate_to_datetime
+from xml.etree import ElementTree
+from xml.sax import saxutils
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+try:
+    # Shipped in the Lambda layer, for the Brotli variants of the feeds
+    import brotli
+except ImportError:
+    brotli = None
+
+# All function logs go through this logger, at LOG_LEVEL. Lambda installs a
+# handler on the root logger; elsewhere the messages are written to stderr.
+# Feed and model content is passed through redact().
+logger = logging.getLogger('awsnews')
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+if not logging.getLogger().handlers:
+    logging.basicConfig(format='%(levelname)s %(message)s')
 
 # Constants
 RSS_TITLE = "AWS NEWS RSS"
@@ -22,41 +58,692 @@ BUCKET_NAME = os.environ['BUCKET_NAME']
 FLOW_EXECUTION_ROLE_ARN = os.environ['FLOW_EXECUTION_ROLE_ARN']
 KEY_NAME = 'awsnews.xml'
 KEY_PROCESSED_NAME = 'processed.xml'
+MAX_ENTRIES_PER_RUN = int(os.environ.get('MAX_ENTRIES_PER_RUN', '50'))
+TIME_BUDGET_RESERVE_MS = int(os.environ.get('TIME_BUDGET_RESERVE_MS', '30000'))
+FLOW_CONCURRENCY = int(os.environ.get('FLOW_CONCURRENCY', '4'))
+FLOW_MAX_ATTEMPTS = int(os.environ.get('FLOW_MAX_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '1'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '20'))
+KEY_RETRY_QUEUE_NAME = 'retry_queue.json'
+KEY_FEED_STATE_NAME = 'feed_state.json'
+FEED_FETCH_TIMEOUT = float(os.environ.get('FEED_FETCH_TIMEOUT', '10'))
+FEED_FETCH_CONCURRENCY = int(os.environ.get('FEED_FETCH_CONCURRENCY', '8'))
+FEED_USER_AGENT = 'AWSNews-RSS/1.0 (+feedparser)'
+KEY_PROCESSED_INDEX_NAME = 'processed_ids.idx'
+KEY_NEAR_DUPLICATE_INDEX_NAME = 'near_duplicates.idx'
+NEAR_DUPLICATE_FILTER = os.environ.get('NEAR_DUPLICATE_FILTER', 'on')
+# SimHash signatures are split in SIMHASH_BLOCKS blocks; two signatures within
+# NEAR_DUPLICATE_DISTANCE bits share at least one block as long as the
+# distance is smaller than the number of blocks
+SIMHASH_BLOCKS = 8
+SIMHASH_BLOCK_BITS = 64 // SIMHASH_BLOCKS
+NEAR_DUPLICATE_DISTANCE = min(int(os.environ.get('NEAR_DUPLICATE_DISTANCE', '7')), SIMHASH_BLOCKS - 1)
+SHINGLE_SIZE = 3
+FEED_CHUNK_SIZE = 64 * 1024
+FEED_ITEM_START = re.compile(rb'<item[\s>]')
+FEED_LAST_BUILD_DATE = re.compile(rb'<lastBuildDate>.*?</lastBuildDate>', re.S)
+FEED_ITEM_GUID = re.compile(rb'<guid[^>]*>(.*?)</guid>', re.S)
+FEED_ITEM_LINK = re.compile(rb'<link>(.*?)</link>', re.S)
+FEED_PUB_DATE = re.compile(rb'<pubDate>(.*?)</pubDate>', re.S)
+FEED_RSS_START = re.compile(rb'<rss\b[^>]*>')
+FEED_CHANNEL_START = re.compile(rb'<channel\b[^>]*>')
+ATOM_NS = b'http://www.w3.org/2005/Atom'
+FH_NS = b'http://purl.org/syndication/history/1.0'
+FEED_MAX_ITEMS = int(os.environ.get('FEED_MAX_ITEMS', '200'))
+FEED_MAX_AGE_DAYS = int(os.environ.get('FEED_MAX_AGE_DAYS', '0'))
+FEED_BASE_URL = os.environ.get('FEED_BASE_URL', '')
+ARCHIVE_PREFIXES = {
+    KEY_NAME: 'archive/',
+    KEY_PROCESSED_NAME: 'archive/processed/'
+}
+# Published feeds get pre-compressed variants, picked by the CloudFront function of template.yaml
+FEED_ENCODINGS = [encoding.strip() for encoding in os.environ.get('FEED_ENCODINGS', 'br,gzip').split(',') if encoding.strip()]
+if 'br' in FEED_ENCODINGS and brotli is None:
+    logger.warning("The brotli module is not installed, the br variants of the feeds are written uncompressed")
+FEED_ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+FEED_CONTENT_TYPE = 'application/rss+xml; charset=utf-8'
+# Readers revalidate live feeds after max-age, CloudFront keeps them until they are invalidated
+FEED_CACHE_CONTROL = os.environ.get('FEED_CACHE_CONTROL', 'public, max-age=300, s-maxage=86400')
+ARCHIVE_CACHE_CONTROL = os.environ.get('ARCHIVE_CACHE_CONTROL', 'public, max-age=86400')
+DISTRIBUTION_ID = os.environ.get('DISTRIBUTION_ID', '')
+PROMPT_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+SCOPE_PROMPT_TEMPLATE = """Task: Analyze the provided AWS RSS news item and categorize it based on specific keywords.
+
+Input: An XML string containing an AWS news item, enclosed in <AWSNewsScope> tags.
+
+Instructions:
+1. Parse the XML content within the <AWSNewsScope> tags.
+2. Search for the keywords listed in the Keywords field of the input (case-insensitive).
+3. Categorization:
+   - If any of the keywords are present: Respond with "InTheScope"
+   - If none of the keywords are present: Respond with "OutOfTheScope"
+4. Provide only the categorization result without any additional text.
+
+<AWSNewsScope>
+{{AWSNewsScope}}
+</AWSNewsScope>"""
+RSS_PROMPT_TEMPLATE = """Task: Transform AWS RSS news into a Teams message in the requested language and reformat it as an RSS feed item.
+
+Input: An XML string containing AWS news, enclosed in <RSSnews> tags.
+
+Instructions:
+1. Parse the content within the <RSSnews> tags.
+2. Transform the content into a message in the language given in the Language field, suitable for the audience given in the Audience field.
+3. Reformat the content into a single RSS feed <item> with the following elements:
+   <guid>: Generate a unique identifier
+   <title>: Create a concise title in that language
+   <link>: Include the original news link if available
+   <description>: Summarize the content in that language, limited to 150 words
+4. Respond with only the formatted RSS <item> XML, without any additional text.
+
+<RSSnews>
+{{RSSnews}}
+</RSSnews>"""
+FLOW_TYPE_SCOPE = 'scope'
+FLOW_TYPE_SUMMARY = 'summary'
+FLOW_NAME_PREFIXES = {
+    FLOW_TYPE_SCOPE: 'AWSNews_',
+    FLOW_TYPE_SUMMARY: 'AWSNewsSummary_'
+}
+EXECUTION_BACKEND = os.environ.get('EXECUTION_BACKEND', 'flow')
+CONVERSE_BATCH_SIZE = int(os.environ.get('CONVERSE_BATCH_SIZE', '5'))
+CONVERSE_MAX_TOKENS = int(os.environ.get('CONVERSE_MAX_TOKENS', '4096'))
+PROMPT_INPUT_SECTION = re.compile(r'\s*<(\w+)>\s*\{\{\1\}\}\s*</\1>\s*$')
+BATCH_PROMPT_TEMPLATE = """Apply the task below to each news item independently. The items are enclosed in numbered <news> tags.
+Call the rss_items tool once with one result per item, giving the index of the item and the RSS <item> XML, or null when the task produces no item.
+
+<task>
+{task}
+</task>
+
+{news}"""
+BATCH_OUTPUT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'items': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'index': {'type': 'integer'},
+                    'item': {'type': ['string', 'null']}
+                },
+                'required': ['index', 'item']
+            }
+        }
+    },
+    'required': ['items']
+}
+STUB_LANGUAGE = re.compile(r'\| Language: ([^|]*?) \| ')
+JOURNAL_PREFIX = 'journal/'
+COMMIT_MAX_ATTEMPTS = int(os.environ.get('COMMIT_MAX_ATTEMPTS', '5'))
+CONDITIONAL_WRITE_CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+KEY_BACKFILL_STATE_NAME = os.environ.get('BACKFILL_STATE_KEY', 'backfill_state.json')
+BACKFILL_PREFIX = 'backfill/'
+BACKFILL_JOB_SERVICE = os.environ.get('BACKFILL_JOB_SERVICE', 'bedrock')
+BACKFILL_ROLE_ARN = os.environ.get('BACKFILL_ROLE_ARN', os.environ.get('FLOW_EXECUTION_ROLE_ARN'))
+BACKFILL_LOCAL_DIR = os.environ.get('BACKFILL_LOCAL_DIR', '/tmp/backfill')
+BACKFILL_MIN_RECORDS = int(os.environ.get('BACKFILL_MIN_RECORDS', '100'))
+BACKFILL_POLL_INTERVAL = int(os.environ.get('BACKFILL_POLL_INTERVAL', '30'))
+BACKFILL_RUNNING_STATUSES = ('Submitted', 'Validating', 'Scheduled', 'InProgress', 'Stopping')
+# 'batch' processes the entries in the scheduled invocation, 'queue' hands them to the workers through SQS
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'batch')
+QUEUE_SERVICE = os.environ.get('QUEUE_SERVICE', 'sqs')
+ENTRY_QUEUE_URL = os.environ.get('ENTRY_QUEUE_URL', 'local://entries')
+RESULT_QUEUE_URL = os.environ.get('RESULT_QUEUE_URL', 'local://results')
+KEY_QUEUE_STATE_NAME = 'queue_state.json'
+QUEUE_PENDING_TTL_SECONDS = int(os.environ.get('QUEUE_PENDING_TTL_SECONDS', '86400'))
+QUEUE_MAX_ENQUEUES = int(os.environ.get('QUEUE_MAX_ENQUEUES', '3'))
+QUEUE_SEND_BATCH_SIZE = 10
+# Delivery settings of the local queues, mirroring the SQS event sources of template.yaml
+QUEUE_BATCH_SIZE = int(os.environ.get('QUEUE_BATCH_SIZE', '5'))
+QUEUE_MAX_RECEIVES = int(os.environ.get('QUEUE_MAX_RECEIVES', '5'))
+QUEUE_LOCAL_WORKERS = int(os.environ.get('QUEUE_LOCAL_WORKERS', '4'))
+FLOW_DEFINITION_HASH = re.compile(r'Definition ([0-9a-f]{16})')
+FLOW_PREPARE_TIMEOUT = int(os.environ.get('FLOW_PREPARE_TIMEOUT', '60'))
+FLOW_VERSIONS_KEPT = int(os.environ.get('FLOW_VERSIONS_KEPT', '3'))
+SCOPE_FILTER = os.environ.get('SCOPE_FILTER', 'on')
+SCOPE_KEYWORDS = ['ECS', 'API Gateway', 'Lambda', 'VPC Endpoints', 'S3', 'Cognito', 'ALB', 'WAF', 'SSM', 'Bedrock', 'RDS']
+# Spelled-out names and close relatives of the keywords, left to the model to decide
+SCOPE_AMBIGUOUS_KEYWORDS = ['Elastic Container Service', 'Fargate', 'VPC Endpoint', 'PrivateLink', 'Simple Storage Service', 'Application Load Balancer', 'Web Application Firewall', 'Systems Manager', 'Relational Database Service', 'Aurora']
+SCOPE_IN = 'in'
+SCOPE_OUT = 'out'
+SCOPE_AMBIGUOUS = 'ambiguous'
+SCOPE_FLOW_TYPES = {SCOPE_IN: FLOW_TYPE_SUMMARY, SCOPE_AMBIGUOUS: FLOW_TYPE_SCOPE, SCOPE_OUT: None}
+PROFILE_LANGUAGE = 'French'
+PROFILE_AUDIENCE = 'a large internal project team on Microsoft Teams'
+HTML_TAG = re.compile(r'<[^>]+>')
+FLOW_PROMPT_TEMPLATES = {
+    FLOW_TYPE_SCOPE: [SCOPE_PROMPT_TEMPLATE, RSS_PROMPT_TEMPLATE],
+    FLOW_TYPE_SUMMARY: [RSS_PROMPT_TEMPLATE]
+}
+TRANSLATION_CACHE = os.environ.get('TRANSLATION_CACHE', 's3')
+TRANSLATION_CACHE_PREFIX = 'cache/translations/'
+TRANSLATION_CACHE_TTL_DAYS = int(os.environ.get('TRANSLATION_CACHE_TTL_DAYS', '30'))
+TRANSLATION_CACHE_MAX_ITEMS = int(os.environ.get('TRANSLATION_CACHE_MAX_ITEMS', '1000'))
+ENTRY_VOLATILE_FIELDS = re.compile(r'^Id: .*? \| |\| Published: [^|]*', re.S)
+KEY_FLOW_CACHE_NAME = os.environ.get('FLOW_CACHE_KEY', 'flow_cache.json')
+FLOW_CACHE_TTL_SECONDS = int(os.environ.get('FLOW_CACHE_TTL_SECONDS', '3600'))
+RETRY_QUEUE_MAX_RUNS = int(os.environ.get('RETRY_QUEUE_MAX_RUNS', '10'))
+RETRY_QUEUE_ABANDONED_DAYS = int(os.environ.get('RETRY_QUEUE_ABANDONED_DAYS', '30'))
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {'ServiceUnavailableException', 'InternalServerException', 'ModelNotReadyException', 'ModelTimeoutException'}
+
+SECRET_CACHE_TTL_SECONDS = int(os.environ.get('SECRET_CACHE_TTL_SECONDS', '300'))
+
+# Per-stage timing, token usage and cost, emitted once per invocation
+METRICS_SINK = os.environ.get('METRICS_SINK', 'emf')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AWSNewsRSS')
+LOG_CONTENT = os.environ.get('LOG_CONTENT', 'redact')
+FLOW_TRACE = os.environ.get('FLOW_TRACE', 'on')
+# On-demand USD prices per 1,000 input and output tokens; batch inference is billed at half price
+MODEL_TOKEN_PRICES = {PROMPT_MODEL_ID: (0.003, 0.015)}
+BATCH_PRICE_FACTOR = 0.5
+
+# Shared client settings: keep-alive connections and a pool large enough for the flow workers
+CLIENT_CONFIG = Config(tcp_keepalive=True, max_pool_connections=max(10, FLOW_CONCURRENCY))
+CLIENT_CONFIG_OVERRIDES = {
+    # Throttling is retried by process_batch_with_retry
+    'bedrock-agent-runtime': Config(retries={'total_max_attempts': 1}),
+    'bedrock-runtime': Config(retries={'total_max_attempts': 1})
+}
+
+# State reused by later invocations of this execution environment
+_clients = {}
+_clients_lock = threading.Lock()
+_secret_cache = {}
+_flow_cache = {}
+_feed_state = {}
+_keyword_matchers = {}
+_translation_cache = OrderedDict()
+_translation_cache_lock = threading.Lock()
+_translation_cache_stats = {'hits': 0, 'misses': 0}
+_changed_feeds = set()
+_changed_feeds_lock = threading.Lock()
+_local_queues = {}
+_local_queues_lock = threading.Lock()
+_metrics = {'stages': {}, 'counters': {}}
+_metrics_lock = threading.Lock()
+_cold_start = True
+
+def get_client(service_name):
+    """Return the shared boto3 client for a service, creating it on first use."""
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                started_at = time.perf_counter()
+                config = CLIENT_CONFIG.merge(CLIENT_CONFIG_OVERRIDES[service_name]) if service_name in CLIENT_CONFIG_OVERRIDES else CLIENT_CONFIG
+                client = boto3.client(service_name, config=config)
+                _clients[service_name] = client
+                logger.debug(f"Created {service_name} client in {(time.perf_counter() - started_at) * 1000:.0f} ms")
+    return client
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics['stages'].clear()
+        _metrics['counters'].clear()
+
+def record_stage(stage, seconds):
+    """Add one timed call of a pipeline stage to the metrics of the invocation."""
+    with _metrics_lock:
+        total, count = _metrics['stages'].get(stage, (0.0, 0))
+        _metrics['stages'][stage] = (total + seconds * 1000, count + 1)
+
+@contextmanager
+def timed_stage(stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
+
+def add_metric(name, value=1, unit='Count'):
+    with _metrics_lock:
+        total, _ = _metrics['counters'].get(name, (0, unit))
+        _metrics['counters'][name] = (total + value, unit)
+
+def record_token_usage(input_tokens, output_tokens, price_factor=1.0):
+    """Count the tokens of a model call and its estimated cost."""
+    input_tokens, output_tokens = input_tokens or 0, output_tokens or 0
+    add_metric('InputTokens', input_tokens)
+    add_metric('OutputTokens', output_tokens)
+    if PROMPT_MODEL_ID in MODEL_TOKEN_PRICES:
+        input_price, output_price = MODEL_TOKEN_PRICES[PROMPT_MODEL_ID]
+        add_metric('EstimatedCostUSD', (input_tokens * input_price + output_tokens * output_price) / 1000 * price_factor, 'None')
+
+def redact(text):
+    """Describe feed or model content for the logs without its text, unless LOG_CONTENT is full."""
+    text = str(text)
+    if LOG_CONTENT == 'full':
+        return text
+    return f"<{len(text)} chars, sha256 {hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}>"
+
+def emit_emf_metrics(metrics):
+    """Print the metrics as one CloudWatch Embedded Metric Format record."""
+    record = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+    definitions = []
+    for stage, (total_ms, count) in metrics['stages'].items():
+        record[f"{stage}Time"] = round(total_ms, 1)
+        record[f"{stage}Calls"] = count
+        definitions += [{'Name': f"{stage}Time", 'Unit': 'Milliseconds'}, {'Name': f"{stage}Calls", 'Unit': 'Count'}]
+    for name, (value, unit) in metrics['counters'].items():
+        record[name] = round(value, 6)
+        definitions.append({'Name': name, 'Unit': unit})
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['FunctionName']], 'Metrics': definitions}]
+    }
+    sys.stdout.write(json.dumps(record) + '\n')
+
+def log_metrics(metrics):
+    """Log the metrics as plain lines."""
+    for stage, (total_ms, count) in sorted(metrics['stages'].items(), key=lambda stage: -stage[1][0]):
+        logger.info(f"Stage {stage}: {total_ms:.0f} ms over {count} calls")
+    for name, (value, unit) in metrics['counters'].items():
+        logger.info(f"{name}: {value:g}")
+
+METRICS_SINKS = {
+    'emf': emit_emf_metrics,
+    'log': log_metrics,
+    'off': lambda metrics: None
+}
+
+def emit_metrics():
+    with _metrics_lock:
+        metrics = {'stages': dict(_metrics['stages']), 'counters': dict(_metrics['counters'])}
+    METRICS_SINKS[METRICS_SINK](metrics)
 
 def get_secret(secret_name):
-    session = boto3.session.Session()
-    client = session.client(service_name='secretsmanager')
+    cached = _secret_cache.get(secret_name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    client = get_client('secretsmanager')
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        with timed_stage('SecretFetch'):
+            get_secret_value_response = client.get_secret_value(SecretId=secret_name)
     except ClientError as e:
         raise e
     else:
         if 'SecretString' in get_secret_value_response:
-            return json.loads(get_secret_value_response['SecretString'])
+            secret = json.loads(get_secret_value_response['SecretString'])
         else:
-            return json.loads(base64.b64decode(get_secret_value_response['SecretBinary']))
+            secret = json.loads(base64.b64decode(get_secret_value_response['SecretBinary']))
+    _secret_cache[secret_name] = (secret, time.time() + SECRET_CACHE_TTL_SECONDS)
+    return secret
 
 def get_s3_object(s3_client, key):
     """Retrieve an object from S3."""
     response = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
     return response['Body'].read()
 
+def update_s3_object(s3_client, key, update, **put_args):
+    """Read-modify-write an object with S3 conditional writes.
+
+    update receives the current content (None when the object does not exist)
+    and returns the new content, or None to leave the object as is. The write
+    only succeeds if the object is unchanged since it was read (If-Match on
+    its ETag, If-None-Match when it did not exist); otherwise it is read and
+    updated again, so concurrent writers never lose each other's changes.
+    Returns the content written and its ETag, or (None, None) when the
+    object was left as is.
+    """
+    for attempt in range(COMMIT_MAX_ATTEMPTS):
+        try:
+            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
+            content, condition = response['Body'].read(), {'IfMatch': response['ETag']}
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            content, condition = None, {'IfNoneMatch': '*'}
+        content = update(content)
+        if content is None:
+            return None, None
+        try:
+            response = s3_client.put_object(Body=content, Bucket=BUCKET_NAME, Key=key, **condition, **put_args)
+            return content, response['ETag']
+        except ClientError as e:
+            if get_error_code(e) not in CONDITIONAL_WRITE_CONFLICT_CODES or attempt + 1 >= COMMIT_MAX_ATTEMPTS:
+                raise
+            logger.warning(f"{key} was changed by another invocation, updating it again")
+        time.sleep(backoff_delay(attempt))
+
 def parse_feed(content):
     """Parse RSS feed content."""
     return feedparser.parse(content)
 
-def get_existing_ids(feed):
-    """Get a set of existing entry IDs from a feed."""
-    return set(entry.id for entry in feed.entries)
+def iter_feed_entries(body, links=None, stop=None):
+    """Stream the entries of one of our RSS feeds from a file-like body.
+
+    Items are parsed incrementally and discarded once yielded, so memory does
+    not depend on the size of the feed. Only the fields the pipeline uses are
+    kept: id, title, link, description and published (with published_parsed).
+    The channel's atom:link elements are collected into links (rel -> href).
+    Iteration ends at the first entry for which stop returns True, without
+    reading the rest of the body.
+    """
+    fields = {'guid': 'id', 'title': 'title', 'link': 'link', 'description': 'description', 'pubDate': 'published'}
+    channel = None
+    depth = 0
+    for event, element in ElementTree.iterparse(body, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if element.tag == 'channel':
+                channel = element
+            continue
+        depth -= 1
+        if element.tag == '{%s}link' % ATOM_NS.decode('ascii') and depth == 2 and links is not None:
+            links[element.get('rel')] = element.get('href')
+        elif element.tag == 'item':
+            entry = feedparser.FeedParserDict({fields[child.tag]: (child.text or '').strip() for child in element if child.tag in fields})
+            entry.setdefault('id', entry.get('link'))
+            if entry.get('published'):
+                published = parse_date(entry['published'])
+                if published:
+                    entry['published_parsed'] = published.utctimetuple()
+            element.clear()
+            if channel is not None:
+                channel.clear()
+            if stop is not None and stop(entry):
+                return
+            yield entry
+
+def get_feed_urls(secret):
+    """Return the upstream feed URLs: FEED_URLS (list), or FEED_URL (string or list)."""
+    feed_urls = secret.get('FEED_URLS', secret.get('FEED_URL'))
+    if isinstance(feed_urls, str):
+        feed_urls = feed_urls.split(',')
+    return [feed_url.strip() for feed_url in feed_urls if feed_url.strip()]
+
+def load_feed_states(s3_client):
+    """Load the ETag and Last-Modified values saved for each upstream feed, by URL."""
+    if not _feed_state:
+        try:
+            state = json.loads(get_s3_object(s3_client, KEY_FEED_STATE_NAME))
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            state = {}
+        if 'url' in state:
+            # Single feed state written by earlier versions
+            state = {'feeds': {state['url']: {'etag': state.get('etag'), 'modified': state.get('modified')}}}
+        _feed_state.update(state.get('feeds', {}))
+    return dict(_feed_state)
+
+def save_feed_states(s3_client, states):
+    """Save the validators of every upstream feed if they changed."""
+    if states == _feed_state:
+        return
+    s3_client.put_object(Body=json.dumps({'feeds': states}), Bucket=BUCKET_NAME, Key=KEY_FEED_STATE_NAME, ContentType='application/json')
+    _feed_state.clear()
+    _feed_state.update(states)
+
+def update_feed_states(states, feeds, pending_urls):
+    """Compute the feed validators to keep after a run.
+
+    Validators are only remembered for a feed once none of its entries are
+    left to process, otherwise a 304 on the next run would hide them.
+    """
+    updated = dict(states)
+    for feed_url, feed in feeds.items():
+        if feed is None or feed.get('status') == 304:
+            continue
+        if feed_url in pending_urls:
+            updated.pop(feed_url, None)
+        elif feed.get('etag') or feed.get('modified'):
+            updated[feed_url] = {'etag': feed.get('etag'), 'modified': feed.get('modified')}
+    return updated
+
+def fetch_feed(feed_url, state):
+    """Fetch one upstream feed with a conditional GET and a timeout."""
+    if not feed_url.startswith(('http://', 'https://')):
+        with timed_stage('FeedParse'):
+            return feedparser.parse(feed_url)
+
+    headers = {'User-Agent': FEED_USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('modified'):
+        headers['If-Modified-Since'] = state['modified']
+    try:
+        with timed_stage('FeedFetch'), urllib.request.urlopen(urllib.request.Request(feed_url, headers=headers), timeout=FEED_FETCH_TIMEOUT) as response:
+            content = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        with timed_stage('FeedParse'):
+            feed = feedparser.parse(content, response_headers={key.lower(): value for key, value in response.headers.items()})
+        feed['status'] = response.status
+        feed['etag'] = response.headers.get('ETag')
+        feed['modified'] = response.headers.get('Last-Modified')
+        return feed
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return feedparser.FeedParserDict(status=304, entries=[])
+        raise
+
+def fetch_feeds(feed_urls, states):
+    """Fetch all upstream feeds concurrently; a feed that fails to load maps to None."""
+    def fetch(feed_url):
+        started_at = time.perf_counter()
+        try:
+            feed = fetch_feed(feed_url, states.get(feed_url, {}))
+        except Exception as e:
+            logger.warning(f"Error fetching feed {feed_url}: {str(e)}")
+            return None
+        logger.info(f"Fetched {feed_url}: status {feed.get('status')}, {len(feed.entries)} entries in {(time.perf_counter() - started_at) * 1000:.0f} ms")
+        return feed
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(feed_urls), FEED_FETCH_CONCURRENCY))) as executor:
+        return dict(zip(feed_urls, executor.map(fetch, feed_urls)))
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(value):
+    """Parse an RFC 822 date (any zone or numeric offset) or an ISO 8601 one into an aware UTC datetime, or None.
+
+    Results are cached, as the same dates come back from the feeds on every run.
+    """
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value.strip())
+    except (TypeError, ValueError):
+        try:
+            parsed = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    # Naive dates, and RFC 822 dates with -0000, are taken as UTC
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+def get_entry_datetime(entry):
+    """Return the publication time of a feed entry as an aware UTC datetime, or None when unknown.
+
+    The structs parsed by feedparser are used when present, so entries are
+    only parsed again when they come from the retry queue.
+    """
+    published = entry.get('published_parsed') or entry.get('updated_parsed')
+    if published:
+        return datetime.fromtimestamp(calendar.timegm(published), timezone.utc)
+    return parse_date(entry.get('published') or entry.get('updated'))
+
+def format_entry_date(entry):
+    """Return the publication time of a feed entry in the canonical RFC 822 GMT form, or the original value when unknown."""
+    published = get_entry_datetime(entry)
+    return format_datetime(published, usegmt=True) if published else entry.get('published')
+
+def get_entry_timestamp(entry):
+    """Return the publication time of a feed entry as a Unix timestamp, 0 when unknown."""
+    published = get_entry_datetime(entry)
+    return published.timestamp() if published else 0
+
+def merge_feed_entries(feeds):
+    """Merge the entries of all feeds into one stream, newest first, tagged with their source feed.
+
+    An entry published in several feeds is kept once.
+    """
+    entries = {}
+    for feed_url, feed in feeds.items():
+        for entry in (feed.entries if feed is not None else []):
+            if not entry.get('id'):
+                entry['id'] = entry.get('link') or hashlib.sha1(entry.get('title', '').encode('utf-8')).hexdigest()
+            entry['source_feed'] = feed_url
+            entries.setdefault(entry['id'], entry)
+    return sorted(entries.values(), key=get_entry_timestamp, reverse=True)
+
+def hash_entry_id(entry_id):
+    """Hash an entry ID to the 64-bit key stored in the processed index."""
+    return int.from_bytes(hashlib.blake2b(entry_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def build_processed_index(s3_client):
+    """Build the processed index from processed.xml, for buckets created before the index existed."""
+    logger.info(f"Building {KEY_PROCESSED_INDEX_NAME} from {KEY_PROCESSED_NAME}")
+    body = s3_client.get_object(Bucket=BUCKET_NAME, Key=KEY_PROCESSED_NAME)['Body']
+    index = array('Q', sorted(set(hash_entry_id(entry.id) for entry in iter_feed_entries(body))))
+    s3_client.put_object(Body=index.tobytes(), Bucket=BUCKET_NAME, Key=KEY_PROCESSED_INDEX_NAME, ContentType='application/octet-stream')
+    return index
+
+def load_processed_index(s3_client):
+    """Load the sorted array of processed entry ID hashes.
+
+    The object is the raw uint64 array (little-endian on Lambda), so loading it is a single
+    read and lookups are binary searches, whatever the size of the history.
+    """
+    try:
+        content = get_s3_object(s3_client, KEY_PROCESSED_INDEX_NAME)
+    except ClientError as e:
+        if get_error_code(e) not in ('NoSuchKey', '404'):
+            raise
+        return build_processed_index(s3_client)
+    index = array('Q')
+    index.frombytes(content)
+    return index
+
+def index_contains(index, entry_id):
+    """Check whether an entry ID is in the processed index."""
+    key = hash_entry_id(entry_id)
+    position = bisect.bisect_left(index, key)
+    return position < len(index) and index[position] == key
+
+def save_processed_index(s3_client, index, entry_ids):
+    """Merge entry IDs into the processed index in S3.
+
+    The IDs are merged into the stored index, which may have been extended
+    by another invocation since index was loaded; index is only used when
+    the object does not exist.
+    """
+    keys = sorted(set(hash_entry_id(entry_id) for entry_id in entry_ids))
+
+    def update(content):
+        current = array('Q')
+        if content is None:
+            current = index
+        else:
+            current.frombytes(content)
+        merged = array('Q', (key for key, _ in itertools.groupby(heapq.merge(current, keys))))
+        return merged.tobytes() if len(merged) != len(current) or content is None else None
+
+    update_s3_object(s3_client, KEY_PROCESSED_INDEX_NAME, update, ContentType='application/octet-stream')
+
+def simhash(text):
+    """64-bit SimHash over the word shingles of a text."""
+    words = re.findall(r'\w+', HTML_TAG.sub(' ', text).casefold())
+    shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def entry_simhash(entry):
+    """SimHash signature of an entry's title and description."""
+    return simhash(f"{entry.get('title', '')} {entry.get('description', '')}")
+
+def rotate_signature(signature, block):
+    """Rotate a signature left so that the given block becomes its top bits."""
+    shift = block * SIMHASH_BLOCK_BITS
+    return ((signature << shift) | (signature >> (64 - shift))) & 0xFFFFFFFFFFFFFFFF if shift else signature
+
+def build_near_duplicate_index(signatures):
+    """Build one sorted table of rotated signatures per block."""
+    index = array('Q')
+    for block in range(SIMHASH_BLOCKS):
+        index.extend(sorted(rotate_signature(signature, block) for signature in signatures))
+    return index
+
+def load_near_duplicate_index(s3_client):
+    """Load the SimHash index of processed entries, building it from processed.xml if missing.
+
+    The object holds SIMHASH_BLOCKS sorted uint64 tables back to back, so it is
+    used as loaded and each lookup is a few binary searches.
+    """
+    try:
+        content = get_s3_object(s3_client, KEY_NEAR_DUPLICATE_INDEX_NAME)
+    except ClientError as e:
+        if get_error_code(e) not in ('NoSuchKey', '404'):
+            raise
+        logger.info(f"Building {KEY_NEAR_DUPLICATE_INDEX_NAME} from {KEY_PROCESSED_NAME}")
+        body = s3_client.get_object(Bucket=BUCKET_NAME, Key=KEY_PROCESSED_NAME)['Body']
+        index = build_near_duplicate_index(set(entry_simhash(entry) for entry in iter_feed_entries(body)))
+        # Saved now, as processed.xml later holds near-duplicates whose signatures are not indexed
+        save_near_duplicate_index(s3_client, index, [])
+        return index
+    index = array('Q')
+    index.frombytes(content)
+    return index
+
+def find_near_duplicate(index, signature):
+    """Return a signature of the index within NEAR_DUPLICATE_DISTANCE bits of signature, or None."""
+    size = len(index) // SIMHASH_BLOCKS
+    tables = memoryview(index)
+    for block in range(SIMHASH_BLOCKS):
+        table = tables[block * size:(block + 1) * size]
+        key = rotate_signature(signature, block)
+        prefix = key >> (64 - SIMHASH_BLOCK_BITS) << (64 - SIMHASH_BLOCK_BITS)
+        position = bisect.bisect_left(table, prefix)
+        end = prefix + (1 << (64 - SIMHASH_BLOCK_BITS))
+        while position < size and table[position] < end:
+            if bin(table[position] ^ key).count('1') <= NEAR_DUPLICATE_DISTANCE:
+                return rotate_signature(table[position], (SIMHASH_BLOCKS - block) % SIMHASH_BLOCKS)
+            position += 1
+    return None
+
+def save_near_duplicate_index(s3_client, index, signatures):
+    """Merge signatures into the SimHash index in S3.
+
+    As with the processed index, the signatures are merged into the stored
+    index, and index is only used when the object does not exist. Signatures
+    already in the stored index are not added again.
+    """
+    def update(content):
+        current = array('Q')
+        if content is None:
+            current = index
+        else:
+            current.frombytes(content)
+        size = len(current) // SIMHASH_BLOCKS
+        added = set(signatures) - set(current[:size])
+        if not added and content is not None:
+            return None
+        merged = array('Q')
+        for block in range(SIMHASH_BLOCKS):
+            keys = sorted(rotate_signature(signature, block) for signature in added)
+            merged.extend(heapq.merge(current[block * size:(block + 1) * size], keys))
+        return merged.tobytes()
+
+    update_s3_object(s3_client, KEY_NEAR_DUPLICATE_INDEX_NAME, update, ContentType='application/octet-stream')
 
 def create_rss_item(entry, pub_date=None):
-    """Create an RSS item from an entry."""
+    """Create an RSS item from an entry, dated pub_date or else its own publication time, in UTC."""
+    # PyRSS2Gen writes the date fields as GMT, so the datetime must be in UTC
+    pub_date = pub_date or get_entry_datetime(entry) or datetime.now(timezone.utc)
     return PyRSS2Gen.RSSItem(
         guid=entry.get('id', entry.get('guid')),
         title=entry.get('title'),
         link=entry.get('link'),
         description=entry.get('description'),
-        pubDate=pub_date or datetime.strptime(entry.get('published'), "%a, %d %b %Y %H:%M:%S %Z")
+        pubDate=pub_date.astimezone(timezone.utc) if pub_date.tzinfo else pub_date
     )
 
 def create_rss_feed(items):
@@ -65,14 +752,345 @@ def create_rss_feed(items):
         title=RSS_TITLE,
         link=RSS_LINK,
         description=RSS_DESCRIPTION,
-        lastBuildDate=datetime.now(pytz.UTC),
+        lastBuildDate=datetime.now(timezone.utc),
         items=items
     )
 
-def create_prompt_flow(client):
-    # Replace with the service role that you created.
-    #FLOWS_SERVICE_ROLE = "arn:aws:iam::xxxxxxxxxxxxxxx:role/service-role/AmazonBedrockExecutionRoleForFlows_VHMQ1JP0E8M"
+def render_rss_items(items):
+    """Render RSS items to UTF-8 XML fragments, without the channel around them."""
+    out = io.StringIO()
+    handler = saxutils.XMLGenerator(out, "UTF-8")
+    for item in items:
+        item.publish(handler)
+    return out.getvalue().encode("UTF-8")
+
+def split_feed(body):
+    """Split a feed stream into its channel header, raw <item> elements and footer.
+
+    Items are returned as the original bytes, in document order; nothing is parsed.
+    """
+    buffer = b''
+    header = None
+    items = []
+    while True:
+        chunk = body.read(FEED_CHUNK_SIZE)
+        buffer += chunk
+        if header is None:
+            match = FEED_ITEM_START.search(buffer)
+            if match:
+                header, buffer = buffer[:match.start()], buffer[match.start():]
+            elif not chunk:
+                position = buffer.rfind(b'</channel>')
+                if position < 0:
+                    raise ValueError("Not an RSS feed")
+                return buffer[:position], items, buffer[position:]
+        while header is not None:
+            end = buffer.find(b'</item>')
+            if end < 0:
+                break
+            items.append(buffer[:end + len(b'</item>')])
+            buffer = buffer[end + len(b'</item>'):]
+            match = FEED_ITEM_START.search(buffer)
+            if match and not buffer[:match.start()].strip():
+                buffer = buffer[match.start():]
+            elif match or b'</channel>' in buffer:
+                break
+        if not chunk:
+            return header, items, buffer
+
+def get_item_published(item_xml):
+    """Return the pubDate of a raw <item> element as an aware datetime, or None."""
+    match = FEED_PUB_DATE.search(item_xml)
+    return parse_date(match.group(1).decode('utf-8')) if match else None
+
+def apply_retention(items, now):
+    """Split raw items, newest first, into those kept in the live feed and those to archive."""
+    retained = []
+    archived = []
+    cutoff = now - timedelta(days=FEED_MAX_AGE_DAYS) if FEED_MAX_AGE_DAYS else None
+    for item in items:
+        published = get_item_published(item) if cutoff else None
+        if (FEED_MAX_ITEMS and len(retained) >= FEED_MAX_ITEMS) or (published and published < cutoff):
+            archived.append(item)
+        else:
+            retained.append(item)
+    return retained, archived
+
+def get_feed_url(key):
+    """Return the URL a feed object is served from, for archive links."""
+    return (FEED_BASE_URL.rstrip('/') if FEED_BASE_URL else '') + '/' + key
+
+def set_feed_links(header, links, archive=False):
+    """Set RFC 5005 atom:link elements (rel -> href) in a feed header, and mark archive documents."""
+    rss = FEED_RSS_START.search(header)
+    if rss and b'xmlns:atom=' not in rss.group(0):
+        header = header[:rss.end() - 1] + b' xmlns:atom="' + ATOM_NS + b'"' + header[rss.end() - 1:]
+        rss = FEED_RSS_START.search(header)
+    if archive and b'xmlns:fh=' not in rss.group(0):
+        header = header[:rss.end() - 1] + b' xmlns:fh="' + FH_NS + b'"' + header[rss.end() - 1:]
+
+    elements = b''
+    for rel, href in links.items():
+        header = re.sub(rb'<atom:link rel="' + rel.encode('ascii') + rb'"[^>]*/>', b'', header)
+        elements += f'<atom:link rel="{rel}" href="{saxutils.escape(href)}"/>'.encode('utf-8')
+    if archive and b'<fh:archive/>' not in header:
+        elements += b'<fh:archive/>'
+    channel = FEED_CHANNEL_START.search(header)
+    return header[:channel.end()] + elements + header[channel.end():]
+
+def get_feed_link(header, rel):
+    """Return the href of an atom:link element of a feed header, or None."""
+    match = re.search(rb'<atom:link rel="' + rel.encode('ascii') + rb'" href="([^"]*)"/>', header)
+    return saxutils.unescape(match.group(1).decode('utf-8')) if match else None
+
+def get_item_guid(item_xml):
+    """Return the guid of a raw <item> element, or None."""
+    match = FEED_ITEM_GUID.search(item_xml)
+    return match.group(1).strip() if match else None
+
+def is_published_feed(key):
+    """Whether a feed object is served to readers; processed.xml and its archives are internal."""
+    return key != KEY_PROCESSED_NAME and not key.startswith(ARCHIVE_PREFIXES[KEY_PROCESSED_NAME])
+
+def get_feed_put_args(key):
+    """Headers of a feed object: archives change rarely, so they are cached longer than live feeds."""
+    if not is_published_feed(key):
+        return {'ContentType': FEED_CONTENT_TYPE}
+    return {'ContentType': FEED_CONTENT_TYPE, 'CacheControl': ARCHIVE_CACHE_CONTROL if key.startswith('archive/') else FEED_CACHE_CONTROL}
+
+def compress_feed(content, encoding):
+    """Compress a feed deterministically, so unchanged content keeps the same ETag.
+
+    Returns the body and its Content-Encoding. Without the brotli module the
+    br variant holds the uncompressed feed, so the requests the CloudFront
+    function rewrites to it still resolve.
+    """
+    if encoding == 'gzip':
+        return gzip.compress(content, compresslevel=9, mtime=0), 'gzip'
+    if brotli is None:
+        return content, None
+    return brotli.compress(content, mode=brotli.MODE_TEXT, quality=11), 'br'
+
+def put_feed_variant(s3_client, key, etag, variant_key, variant, put_args):
+    """Write a compressed variant of the feed version with the given ETag.
+
+    The variant records the ETag of its source in its metadata, and is
+    written with a conditional write on the variant read, only while key is
+    still at that version. A writer that committed a newer version writes
+    its own variants after its commit, so an overlapping writer never leaves
+    a variant older than the feed.
+    """
+    for attempt in range(COMMIT_MAX_ATTEMPTS):
+        try:
+            response = s3_client.head_object(Bucket=BUCKET_NAME, Key=variant_key)
+            if response.get('Metadata', {}).get('source-etag') == etag:
+                return
+            condition = {'IfMatch': response['ETag']}
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            condition = {'IfNoneMatch': '*'}
+        if s3_client.head_object(Bucket=BUCKET_NAME, Key=key)['ETag'] != etag:
+            logger.info(f"{key} has a newer version, leaving {variant_key} to its writer")
+            return
+        try:
+            s3_client.put_object(Body=variant, Bucket=BUCKET_NAME, Key=variant_key, Metadata={'source-etag': etag}, **condition, **put_args)
+            return
+        except ClientError as e:
+            if get_error_code(e) not in CONDITIONAL_WRITE_CONFLICT_CODES or attempt + 1 >= COMMIT_MAX_ATTEMPTS:
+                raise
+            logger.warning(f"{variant_key} was changed by another invocation, writing it again")
+        time.sleep(backoff_delay(attempt))
+
+def publish_feed(s3_client, key, content, etag):
+    """Write the compressed variants of a published feed that changed, and mark its path for invalidation.
+
+    content is the version of key committed with the given ETag.
+    """
+    if not is_published_feed(key):
+        return
+    put_args = get_feed_put_args(key)
+    with timed_stage('Compress'):
+        variants = [(encoding, compress_feed(content, encoding)) for encoding in FEED_ENCODINGS]
+    for encoding, (variant, content_encoding) in variants:
+        encoding_args = {'ContentEncoding': content_encoding} if content_encoding else {}
+        put_feed_variant(s3_client, key, etag, key + FEED_ENCODING_SUFFIXES[encoding], variant, dict(put_args, **encoding_args))
+    with _changed_feeds_lock:
+        _changed_feeds.add(f"/{key}*")
+
+def invalidate_changed_feeds():
+    """Invalidate the CloudFront paths of the feeds changed by this invocation, in a single request.
+
+    Unchanged feeds are never invalidated, so CloudFront keeps answering
+    conditional requests with 304. The request is retried up to
+    COMMIT_MAX_ATTEMPTS times. A failed invalidation does not fail the run,
+    since the feeds are committed, but the edge keeps serving the previous
+    copies until s-maxage of FEED_CACHE_CONTROL expires (a day by default),
+    so it is logged as an error and counted in the InvalidationErrors metric.
+    """
+    with _changed_feeds_lock:
+        paths = sorted(_changed_feeds)
+        _changed_feeds.clear()
+    if not paths or not DISTRIBUTION_ID:
+        return
+    for attempt in range(COMMIT_MAX_ATTEMPTS):
+        try:
+            get_client('cloudfront').create_invalidation(
+                DistributionId=DISTRIBUTION_ID,
+                InvalidationBatch={'Paths': {'Quantity': len(paths), 'Items': paths}, 'CallerReference': f"{int(time.time() * 1000)}-{secrets.token_hex(4)}"}
+            )
+            logger.info(f"Invalidated {', '.join(paths)}")
+            add_metric('InvalidatedPaths', len(paths))
+            return
+        except ClientError as e:
+            if attempt + 1 >= COMMIT_MAX_ATTEMPTS:
+                logger.error(f"Error invalidating {', '.join(paths)}, stale until s-maxage: {str(e)}")
+                add_metric('InvalidationErrors')
+                return
+            logger.warning(f"Error invalidating {', '.join(paths)}, retrying: {str(e)}")
+        time.sleep(backoff_delay(attempt))
+
+def find_archive_neighbours(s3_client, latest, segment_url):
+    """Find where a segment older than the head of an archive chain belongs.
+
+    Walks the prev-archive links from latest and returns the key of the first
+    segment newer than segment_url with its prev-archive URL, which becomes
+    the prev-archive of the inserted segment. Returns (None, latest) when
+    the chain cannot be followed.
+    """
+    base_url = get_feed_url('')
+    url = latest
+    seen = set()
+    while url and url.startswith(base_url) and url not in seen:
+        seen.add(url)
+        key = url[len(base_url):]
+        try:
+            content = get_s3_object(s3_client, key)
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            break
+        previous = get_feed_link(split_feed(io.BytesIO(content))[0], 'prev-archive')
+        if previous is None or previous <= segment_url:
+            return key, previous
+        url = previous
+    return None, latest
+
+def set_archive_link(s3_client, key, previous_url):
+    """Point the prev-archive link of an archive segment at previous_url."""
+    def update(content):
+        if content is None:
+            return None
+        segment_header, segment_items, segment_footer = split_feed(io.BytesIO(content))
+        if get_feed_link(segment_header, 'prev-archive') == previous_url:
+            return None
+        if previous_url:
+            segment_header = set_feed_links(segment_header, {'prev-archive': previous_url}, archive=True)
+        else:
+            segment_header = re.sub(rb'<atom:link rel="prev-archive"[^>]*/>', b'', segment_header)
+        return b''.join([segment_header] + segment_items + [segment_footer])
+
+    content, etag = update_s3_object(s3_client, key, update, **get_feed_put_args(key))
+    if content is not None:
+        publish_feed(s3_client, key, content, etag)
+
+def archive_feed_items(s3_client, key, items, header, now):
+    """Move raw items out of a live feed into monthly archive segments.
+
+    Items are prepended to archive/<prefix>YYYY-MM.xml by publication month,
+    skipping those already archived, so a retried update archives them once.
+    Each new segment links back to the previous one, so readers can walk the
+    history from the live feed. A segment older than the head of the chain,
+    created by a backfill, is linked in date order between its neighbours.
+    Returns the URL of the latest segment.
+    """
+    segments = {}
+    for item in items:
+        published = get_item_published(item) or now
+        segments.setdefault(ARCHIVE_PREFIXES.get(key, f"archive/{key.rsplit('.', 1)[0]}/") + published.strftime('%Y-%m') + '.xml', []).append(item)
+
+    latest = get_feed_link(header, 'prev-archive')
+    for segment_key in sorted(segments):
+        segment_url = get_feed_url(segment_key)
+        newer_key, previous_url = None, latest
+        if latest and segment_url < latest:
+            newer_key, previous_url = find_archive_neighbours(s3_client, latest, segment_url)
+            if previous_url == segment_url:
+                # Already linked
+                newer_key, previous_url = None, None
+
+        def update(content):
+            if content is None:
+                links = {'current': get_feed_url(key)}
+                if previous_url and previous_url != segment_url:
+                    links['prev-archive'] = previous_url
+                segment_header, segment_items, segment_footer = split_feed(io.BytesIO(create_rss_feed([]).to_xml("UTF-8").encode("UTF-8")))
+                segment_header = set_feed_links(segment_header, links, archive=True)
+            else:
+                segment_header, segment_items, segment_footer = split_feed(io.BytesIO(content))
+            archived_guids = set(get_item_guid(item) for item in segment_items) - {None}
+            added = [item for item in segments[segment_key] if get_item_guid(item) not in archived_guids]
+            if not added and content is not None:
+                return None
+            logger.info(f"Archived {len(added)} items from {key} to {segment_key}")
+            return b''.join([segment_header] + added + segment_items + [segment_footer])
+
+        content, etag = update_s3_object(s3_client, segment_key, update, **get_feed_put_args(segment_key))
+        if content is not None:
+            publish_feed(s3_client, segment_key, content, etag)
+        if newer_key is not None:
+            # The segment joins the chain, or is repaired if it was created outside of it
+            set_archive_link(s3_client, segment_key, previous_url)
+            set_archive_link(s3_client, newer_key, segment_url)
+        if latest is None or segment_url > latest:
+            latest = segment_url
+    return latest
+
+def splice_feed_items(s3_client, key, new_items, merge=False):
+    """Insert raw <item> elements at the top of a feed object without rebuilding it.
 
+    Existing items are carried over as raw XML and never parsed or
+    re-serialised, and items whose guid is already in the feed are skipped,
+    so applying the same items twice adds them once. Items beyond the
+    retention window are moved to archive segments, so the live feed stays
+    a constant size. With merge, the items are placed by publication date
+    instead and replace existing items with the same link, for backfills of
+    older entries. The feed is written with a conditional write.
+    """
+    def update(content):
+        now = datetime.now(timezone.utc)
+        if content is None:
+            content = create_rss_feed([]).to_xml("UTF-8").encode("UTF-8")
+        header, existing_items, footer = split_feed(io.BytesIO(content))
+        header = FEED_LAST_BUILD_DATE.sub(b'<lastBuildDate>' + format_datetime(now, usegmt=True).encode('ascii') + b'</lastBuildDate>', header, count=1)
+
+        items = new_items
+        if merge:
+            links = set(FEED_ITEM_LINK.search(item).group(1) for item in items if FEED_ITEM_LINK.search(item))
+            existing_items = [item for item in existing_items if not (FEED_ITEM_LINK.search(item) and FEED_ITEM_LINK.search(item).group(1) in links)]
+            oldest = datetime.min.replace(tzinfo=timezone.utc)
+            existing_items = sorted(items + existing_items, key=lambda item: get_item_published(item) or oldest, reverse=True)
+            items = []
+        else:
+            existing_guids = set(get_item_guid(item) for item in existing_items) - {None}
+            items = [item for item in items if get_item_guid(item) not in existing_guids]
+            if not items:
+                return None
+        retained, archived = apply_retention(items + existing_items, now)
+        if archived:
+            header = set_feed_links(header, {'prev-archive': archive_feed_items(s3_client, key, archived, header, now)})
+        return b''.join([header] + retained + [footer])
+
+    content, etag = update_s3_object(s3_client, key, update, **get_feed_put_args(key))
+    if content is not None:
+        publish_feed(s3_client, key, content, etag)
+
+def prepend_feed_items(s3_client, key, items, merge=False):
+    """Insert RSS items at the top of a feed object, see splice_feed_items."""
+    splice_feed_items(s3_client, key, [render_rss_items([item]) for item in items], merge)
+
+def build_flow_definition(flow_type=FLOW_TYPE_SCOPE):
+    """Build the nodes and connections of the flow of the given type."""
     # Define each node
 
      # Input node: validates that the content of the InvokeFlow request is a JSON object
@@ -96,7 +1114,7 @@ def create_prompt_flow(client):
             "prompt": {
                 "sourceConfiguration": {
                     "inline": {
-                        "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
+                        "modelId": PROMPT_MODEL_ID,
                         "templateType": "TEXT",
                         "inferenceConfiguration": {
                             "text": {
@@ -105,22 +1123,7 @@ def create_prompt_flow(client):
                         },
                         "templateConfiguration": {
                             "text": {
-                                "text": """Task: Analyze the provided AWS RSS news item and categorize it based on specific keywords.
-
-Input: An XML string containing an AWS news item, enclosed in <AWSNewsScope> tags.
-
-Instructions:
-1. Parse the XML content within the <AWSNewsScope> tags.
-2. Search for the following keywords (case-insensitive):
-   ECS, API Gateway, Lambda, VPC Endpoints, S3, Cognito, ALB, WAF, SSM, Bedrock, RDS
-3. Categorization:
-   - If any of the keywords are present: Respond with "InTheScope"
-   - If none of the keywords are present: Respond with "OutOfTheScope"
-4. Provide only the categorization result without any additional text.
-
-<AWSNewsScope>
-{{AWSNewsScope}}
-</AWSNewsScope>"""
+                                "text": SCOPE_PROMPT_TEMPLATE
                             }
                         }
                     }
@@ -178,7 +1181,7 @@ Instructions:
             "prompt": {
                 "sourceConfiguration": {
                     "inline": {
-                        "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
+                        "modelId": PROMPT_MODEL_ID,
                         "templateType": "TEXT",
                         "inferenceConfiguration": {
                             "text": {
@@ -187,23 +1190,7 @@ Instructions:
                         },
                         "templateConfiguration": {
                             "text": {
-                                "text": """Task: Transform AWS RSS news into a French Teams message and reformat it as an RSS feed item.
-
-Input: An XML string containing AWS news, enclosed in <RSSnews> tags.
-
-Instructions:
-1. Parse the content within the <RSSnews> tags.
-2. Transform the content into a French message suitable for a large internal project team on Microsoft Teams.
-3. Reformat the content into a single RSS feed <item> with the following elements:
-   <guid>: Generate a unique identifier
-   <title>: Create a concise French title
-   <link>: Include the original news link if available
-   <description>: Summarize the content in French, limited to 150 words
-4. Respond with only the formatted RSS <item> XML, without any additional text.
-
-<RSSnews>
-{{RSSnews}}
-</RSSnews>"""
+                                "text": RSS_PROMPT_TEMPLATE
                             }
                         }
                     }
@@ -322,76 +1309,395 @@ Instructions:
         }
     )
 
-    flows_response = client.list_flows()
-    print (str(flows_response))
-    flows = flows_response.get('flowSummaries', [])
+    nodes = [input_node, prompt_node1, condition_node, prompt_node, output_node]
+    if flow_type == FLOW_TYPE_SUMMARY:
+        # Summarization only, for items already scoped by the local keyword filter
+        nodes = [input_node, prompt_node, output_node]
+        connections = [connection for connection in connections if connection["source"] != condition_node["name"] and connection["target"] not in (prompt_node1["name"], condition_node["name"])]
 
-    # Iterate through the flows and delete those starting with "AWSNEWS"
-    for flow in flows:
-        if flow.get('name', '').startswith('AWSNews'):
-            flow_id = flow['id']
+    return {
+        "nodes": nodes,
+        "connections": connections
+    }
 
-            flow_aliases_response = client.list_flow_aliases(flowIdentifier=flow_id)
-            print ("flow aliases: " + str(flow_aliases_response))
-            flow_aliaes = flow_aliases_response.get('flowAliasSummaries', [])
-            for flow_alias in flow_aliaes:
-                flow_alias_id = flow_alias['id']
-                if flow_alias_id != 'TSTALIASID':
-                    client.delete_flow_alias(flowIdentifier=flow_id, aliasIdentifier=flow_alias_id)
+def flow_definition_hash(definition):
+    """Hash a flow definition and its execution role, to tell deployed flows apart from the current code."""
+    content = json.dumps({'definition': definition, 'executionRoleArn': FLOW_EXECUTION_ROLE_ARN}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
 
-            try:
-                delete_response = client.delete_flow(flowIdentifier=flow_id)
-                print(f"Deleted flow: {flow['name']}")
-            except client.exceptions.ResourceNotFoundException:
-                print(f"Flow {flow['name']} not found.")
-            except Exception as e:
-                print(f"Error deleting flow {flow['name']}: {e}")
+def get_definition_hash(description):
+    """Return the definition hash recorded in a flow, version or alias description, if any."""
+    match = FLOW_DEFINITION_HASH.search(description or '')
+    return match.group(1) if match else None
+
+def wait_for_flow_prepared(client, flow_id):
+    """Poll the flow until its working draft is prepared, raising if preparation fails or times out."""
+    deadline = time.monotonic() + FLOW_PREPARE_TIMEOUT
+    delay = 0.5
+    while True:
+        response = client.get_flow(flowIdentifier=flow_id)
+        status = response.get('status')
+        if status == 'Prepared':
+            return
+        if status == 'Failed' or time.monotonic() + delay > deadline:
+            raise RuntimeError(f"Flow {flow_id} not prepared ({status}): {response.get('validations', [])}")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+def publish_flow_version(client, flow_id, definition_hash, flow_alias_id=None):
+    """Prepare the working draft, snapshot it as a version and point the 'latest' alias at it.
 
+    The alias is updated in place, so invocations keep running on the previous
+    version until the swap.
+    """
+    client.prepare_flow(flowIdentifier=flow_id)
+    wait_for_flow_prepared(client, flow_id)
+    response = client.create_flow_version(flowIdentifier=flow_id, description=f"Definition {definition_hash}")
+    flow_version = response.get("version")
+
+    alias = {
+        "flowIdentifier": flow_id,
+        "name": "latest",
+        "description": f"Alias pointing to the latest version of the flow. Definition {definition_hash}",
+        "routingConfiguration": [
+            {
+                "flowVersion": flow_version
+            }
+        ]
+    }
+    if flow_alias_id:
+        client.update_flow_alias(aliasIdentifier=flow_alias_id, **alias)
+    else:
+        flow_alias_id = client.create_flow_alias(**alias).get("id")
+
+    prune_flow_versions(client, flow_id, flow_version)
+    return flow_alias_id
+
+def prune_flow_versions(client, flow_id, flow_version):
+    """Delete the oldest numbered versions, keeping the new one and its predecessors up to FLOW_VERSIONS_KEPT."""
+    versions = []
+    kwargs = {'flowIdentifier': flow_id}
+    while True:
+        response = client.list_flow_versions(**kwargs)
+        versions.extend(summary['version'] for summary in response.get('flowVersionSummaries', []) if summary.get('version', 'DRAFT').isdigit())
+        if not response.get('nextToken'):
+            break
+        kwargs['nextToken'] = response['nextToken']
+
+    for version in sorted(versions, key=int, reverse=True)[FLOW_VERSIONS_KEPT:]:
+        if version == flow_version:
+            continue
+        try:
+            client.delete_flow_version(flowIdentifier=flow_id, flowVersion=version)
+        except Exception as e:
+            logger.warning(f"Error deleting version {version} of flow {flow_id}: {e}")
+
+def create_prompt_flow(client, flow_type=FLOW_TYPE_SCOPE):
+    """Create the flow of the given type with a prepared version and its 'latest' alias."""
+    definition = build_flow_definition(flow_type)
+    definition_hash = flow_definition_hash(definition)
 
     # Create the flow from the nodes and connections
-    #flow_name = f"AWSNews_{random.randint(1000, 9999)}_{int(time.time())}"
-    flow_name = f"AWSNews_{secrets.randbelow(9000) + 1000}_{int(time.time())}"
+    flow_name = f"{FLOW_NAME_PREFIXES[flow_type]}{secrets.randbelow(9000) + 1000}_{int(time.time())}"
     response = client.create_flow(
         name=flow_name,
-        description="A flow that creates a personalised RSS.",
+        description=f"A flow that creates a personalised RSS. Definition {definition_hash}",
         executionRoleArn=FLOW_EXECUTION_ROLE_ARN,
-        definition={
-            "nodes": [input_node, prompt_node1, condition_node, prompt_node, output_node],
-            "connections": connections
-        }
+        definition=definition
     )
 
     # Extract and return the flow ID from the response
     flow_id = response.get("id")
-    client.prepare_flow(flowIdentifier=flow_id)
-    response = client.create_flow_version(flowIdentifier=flow_id)
-                                    
-    flow_version = response.get("version")
-    response = client.create_flow_alias(
+    flow_alias_id = publish_flow_version(client, flow_id, definition_hash)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "flowId": flow_id,
+            "flow_alias_Id": flow_alias_id,
+            "definition": definition_hash,
+            "message": "Flow created successfully"
+        })
+    }
+
+def update_prompt_flow(client, existing_flow, flow_alias_id, flow_type=FLOW_TYPE_SCOPE):
+    """Update an existing flow in place to the current definition, then swap its alias to a new version."""
+    definition = build_flow_definition(flow_type)
+    definition_hash = flow_definition_hash(definition)
+    flow_id = existing_flow['id']
+
+    client.update_flow(
         flowIdentifier=flow_id,
-        name="latest",
-        description="Alias pointing to the latest version of the flow.",
-        routingConfiguration=[
-            {
-                "flowVersion": flow_version
-            }
-        ]
+        name=existing_flow['name'],
+        description=f"A flow that creates a personalised RSS. Definition {definition_hash}",
+        executionRoleArn=FLOW_EXECUTION_ROLE_ARN,
+        definition=definition
     )
-    
-    flow_alias_id = response.get("id")
+    flow_alias_id = publish_flow_version(client, flow_id, definition_hash, flow_alias_id)
+
+    logger.info(f"Updated flow {existing_flow['name']} to definition {definition_hash}")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "flowId": flow_id,
+            "flow_alias_Id": flow_alias_id,
+            "definition": definition_hash,
+            "message": "Flow updated successfully"
+        })
+    }
+
+
+def get_config_list(secret, name, default):
+    """Read a list setting from the secret, then the environment (comma-separated), then the default."""
+    value = secret.get(name, os.environ.get(name))
+    if value is None:
+        return default
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() for item in value if item.strip()]
+
+def normalize_keyword(keyword):
+    """Normalize a keyword or a matched text for comparison."""
+    return ' '.join(keyword.split()).casefold()
+
+def load_profiles(secret):
+    """Return the audience profiles: keywords, language, audience and output key of each team.
+
+    Profiles come from the PROFILES list of the secret; without it a single
+    default profile writes awsnews.xml. Missing fields take the defaults.
+    """
+    default = {
+        'name': 'default',
+        'keywords': get_config_list(secret, 'SCOPE_KEYWORDS', SCOPE_KEYWORDS),
+        'ambiguous_keywords': get_config_list(secret, 'SCOPE_AMBIGUOUS_KEYWORDS', SCOPE_AMBIGUOUS_KEYWORDS),
+        'language': PROFILE_LANGUAGE,
+        'audience': PROFILE_AUDIENCE,
+        'output_key': KEY_NAME
+    }
+    configured = secret.get('PROFILES')
+    if isinstance(configured, str):
+        configured = json.loads(configured)
+    if not configured:
+        profiles = [default]
+    else:
+        profiles = [{**default, 'output_key': f"{profile['name']}.xml", **profile} for profile in configured]
+
+    output_keys = [profile['output_key'] for profile in profiles]
+    if len(set(output_keys)) != len(output_keys) or KEY_PROCESSED_NAME in output_keys:
+        raise ValueError(f"Profile output keys must be unique and different from {KEY_PROCESSED_NAME}: {output_keys}")
+    for profile in profiles:
+        profile['keyword_set'] = set(normalize_keyword(keyword) for keyword in profile['keywords'])
+        profile['ambiguous_keyword_set'] = set(normalize_keyword(keyword) for keyword in profile['ambiguous_keywords'])
+    return profiles
+
+def compile_keyword_matcher(keywords):
+    """Compile keywords into one case-insensitive regex matching whole words only."""
+    key = tuple(sorted(set(keywords)))
+    matcher = _keyword_matchers.get(key)
+    if matcher is None:
+        # Longest keywords first so "API Gateway" wins over a shorter overlapping keyword
+        patterns = [re.escape(keyword).replace(r'\ ', r'\s+') for keyword in sorted(key, key=len, reverse=True)]
+        matcher = re.compile(r'\b(?:' + '|'.join(patterns) + r')\b', re.IGNORECASE) if patterns else None
+        _keyword_matchers[key] = matcher
+    return matcher
+
+def match_keywords(entry, matcher):
+    """Return the normalized keywords found in an entry's title and description."""
+    if matcher is None:
+        return set()
+    text = HTML_TAG.sub(' ', f"{entry.get('title', '')} {entry.get('description', '')}")
+    return set(normalize_keyword(match.group(0)) for match in matcher.finditer(text))
+
+def classify_entry(matched, profile):
+    """Scope an entry for a profile: in (a keyword matches), ambiguous (a related name matches) or out."""
+    if matched & profile['keyword_set']:
+        return SCOPE_IN
+    if matched & profile['ambiguous_keyword_set']:
+        return SCOPE_AMBIGUOUS
+    return SCOPE_OUT
 
-    FLOW_IDENTIFIER = flow_id
-    FLOW_ALIAS_IDENTIFIER = flow_alias_id
+def stage_commit(s3_client, run_id, feed_items, processed_ids, signatures):
+    """Write the results of a run to the journal before any shared object is updated.
 
+    feed_items maps feed keys to their new raw <item> elements, processed.xml
+    included. Once the journal exists, apply_commit can finish the commit even
+    if this invocation dies.
+    """
+    journal = {
+        'run_id': run_id,
+        'feeds': {key: [item.decode('utf-8') for item in items] for key, items in feed_items.items() if items},
+        'processed_ids': processed_ids,
+        'signatures': signatures
+    }
+    s3_client.put_object(Body=json.dumps(journal), Bucket=BUCKET_NAME, Key=f"{JOURNAL_PREFIX}{run_id}.json", ContentType='application/json', IfNoneMatch='*')
+    return journal
+
+def apply_commit(s3_client, journal, processed_index=None, near_duplicate_index=None):
+    """Apply a journaled commit: output feeds, then processed.xml, then the indexes, then drop the journal.
+
+    Every step is idempotent and uses conditional writes, so a commit can be
+    replayed after a crash, or applied by two invocations at once. Entries
+    only count as processed once the processed index is written, after their
+    items are in the feeds.
+    """
+    feeds = journal['feeds']
+    for key in sorted(feeds, key=lambda key: key == KEY_PROCESSED_NAME):
+        splice_feed_items(s3_client, key, [item.encode('utf-8') for item in feeds[key]])
+    if journal['processed_ids']:
+        save_processed_index(s3_client, processed_index if processed_index is not None else load_processed_index(s3_client), journal['processed_ids'])
+    if journal['signatures']:
+        save_near_duplicate_index(s3_client, near_duplicate_index if near_duplicate_index is not None else load_near_duplicate_index(s3_client), journal['signatures'])
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key=f"{JOURNAL_PREFIX}{journal['run_id']}.json")
+
+def recover_commits(s3_client):
+    """Replay the journaled commits left behind by invocations that stopped before finishing them."""
+    journal_keys = []
+    kwargs = {'Bucket': BUCKET_NAME, 'Prefix': JOURNAL_PREFIX}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        journal_keys.extend(item['Key'] for item in sorted(response.get('Contents', []), key=lambda item: item['LastModified']))
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    for journal_key in journal_keys:
+        try:
+            journal = json.loads(get_s3_object(s3_client, journal_key))
+        except ClientError as e:
+            # Applied by another invocation in the meantime
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                continue
+            raise
+        logger.info(f"Replaying journaled commit {journal['run_id']}")
+        apply_commit(s3_client, journal)
+
+def route_entries(entries, profiles, skipped=()):
+    """Scope entries for every profile and build the flow requests they need.
+
+    Entries are matched once against the keywords of all profiles. Returns
+    the (entry, flow_type, document) requests, identical ones sent once, and
+    for each entry its (profile, request position) routes. Entries at the
+    skipped positions get no route.
+    """
+    matcher = compile_keyword_matcher([keyword for profile in profiles for keyword in profile['keywords'] + profile['ambiguous_keywords']])
+    requests = []
+    request_positions = {}
+    entry_routes = []
+    for position, entry in enumerate(entries):
+        routes = []
+        entry_routes.append(routes)
+        if position in skipped:
+            continue
+        matched = match_keywords(entry, matcher) if SCOPE_FILTER != 'off' else None
+        for profile in profiles:
+            flow_type = FLOW_TYPE_SCOPE if matched is None else SCOPE_FLOW_TYPES[classify_entry(matched, profile)]
+            if flow_type is None:
+                continue
+            document = format_request(entry, profile, flow_type)
+            request_position = request_positions.setdefault((flow_type, document), len(requests))
+            if request_position == len(requests):
+                requests.append((entry, flow_type, document))
+            routes.append((profile, request_position))
+    logger.info(f"Local scoping: {len(requests)} Bedrock requests for {sum(len(routes) for routes in entry_routes)} profile matches over {len(entries)} entries and {len(profiles)} profiles")
+    return requests, entry_routes
+
+def list_all_flows(client):
+    """List all flow summaries, following nextToken pagination."""
+    flows = []
+    kwargs = {}
+    while True:
+        response = client.list_flows(**kwargs)
+        flows.extend(response.get('flowSummaries', []))
+        if not response.get('nextToken'):
+            return flows
+        kwargs['nextToken'] = response['nextToken']
+
+def list_all_flow_aliases(client, flow_id):
+    """List all alias summaries of a flow, following nextToken pagination."""
+    aliases = []
+    kwargs = {'flowIdentifier': flow_id}
+    while True:
+        response = client.list_flow_aliases(**kwargs)
+        aliases.extend(response.get('flowAliasSummaries', []))
+        if not response.get('nextToken'):
+            return aliases
+        kwargs['nextToken'] = response['nextToken']
+
+def resolve_flow(client, flow_type=FLOW_TYPE_SCOPE):
+    """Find the flow of the given type and its 'latest' alias, creating or updating them if needed.
+
+    The alias records the hash of the definition it serves: a matching flow is
+    used as is, a stale one is updated in place and gets a new version.
+    """
+    # Check for existing flows starting with the prefix of the type, e.g. "AWSNews_"
+    flows = list_all_flows(client)
+    existing_flows = [flow for flow in flows if flow['name'].startswith(FLOW_NAME_PREFIXES[flow_type])]
+
+    if not existing_flows:
+        # Create a new flow
+        return create_prompt_flow(client, flow_type)
+
+    # Use the most recently updated flow if earlier deployments left several
+    existing_flow = max(existing_flows, key=lambda flow: str(flow.get('updatedAt', '')))
+    flow_id = existing_flow['id']
+    flow_aliases = list_all_flow_aliases(client, flow_id)
+    flow_alias = next((alias for alias in flow_aliases if alias['name'] == 'latest'), None)
+    flow_alias_id = flow_alias['id'] if flow_alias else None
+
+    definition_hash = flow_definition_hash(build_flow_definition(flow_type))
+    if not flow_alias or get_definition_hash(flow_alias.get('description')) != definition_hash:
+        return update_prompt_flow(client, existing_flow, flow_alias_id, flow_type)
+
+    logger.info(f"Using existing flow: {existing_flow['name']}")
     return {
         "statusCode": 200,
         "body": json.dumps({
             "flowId": flow_id,
             "flow_alias_Id": flow_alias_id,
-            "message": "Flow created successfully"
+            "definition": definition_hash,
+            "message": "Existing flow retrieved successfully"
         })
     }
 
+def get_cached_flow(s3_client, flow_type=FLOW_TYPE_SCOPE):
+    """Return the cached flow resolution, from memory or the S3 sidecar, if still fresh.
+
+    A resolution made for another flow definition is stale, so a deployment
+    that changes the prompts updates the flow on its first run.
+    """
+    definition_hash = flow_definition_hash(build_flow_definition(flow_type))
+    if _flow_cache.get(flow_type, {}).get('expires_at', 0) > time.time() and _flow_cache[flow_type].get('definition') == definition_hash:
+        return _flow_cache[flow_type]['result_flow']
+
+    if not KEY_FLOW_CACHE_NAME:
+        return None
+    try:
+        cached = json.loads(get_s3_object(s3_client, KEY_FLOW_CACHE_NAME))
+    except ClientError as e:
+        if get_error_code(e) not in ('NoSuchKey', '404'):
+            logger.warning(f"Error reading flow cache: {str(e)}")
+        return None
+    cached = {key: value for key, value in cached.items() if isinstance(value, dict) and value.get('expires_at', 0) > time.time()}
+    _flow_cache.update(cached)
+    if cached.get(flow_type, {}).get('definition') != definition_hash:
+        return None
+
+    logger.debug(f"Using cached {flow_type} flow")
+    return cached[flow_type]['result_flow']
+
+def cache_flow(s3_client, result_flow, flow_type=FLOW_TYPE_SCOPE):
+    """Cache a flow resolution in memory and in the S3 sidecar."""
+    definition_hash = json.loads(result_flow['body']).get('definition')
+    _flow_cache[flow_type] = {'result_flow': result_flow, 'definition': definition_hash, 'expires_at': time.time() + FLOW_CACHE_TTL_SECONDS}
+    if KEY_FLOW_CACHE_NAME:
+        s3_client.put_object(Body=json.dumps(_flow_cache), Bucket=BUCKET_NAME, Key=KEY_FLOW_CACHE_NAME, ContentType='application/json')
+
+def invalidate_flow_cache(s3_client):
+    """Drop the cached flow resolutions after a flow or alias disappeared."""
+    logger.info("Flow not found, invalidating the flow cache")
+    _flow_cache.clear()
+    if KEY_FLOW_CACHE_NAME:
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=KEY_FLOW_CACHE_NAME)
 
 def invoke_bedrock_flow(client_runtime, result_flow, input_content):
     #print ("flow id " + FLOW_IDENTIFIER + " " + FLOW_ALIAS_IDENTIFIER)
@@ -403,10 +1709,7 @@ def invoke_bedrock_flow(client_runtime, result_flow, input_content):
         # Extract the flowId and flow_alias_Id
         flow_id = body_json['flowId']
         flow_alias_id = body_json['flow_alias_Id']
-        
-        # Print the extracted values
-        print(f"Flow ID: {flow_id}")
-        print(f"Flow Alias ID: {flow_alias_id}")
+
     
         #"""Invoke Bedrock flow and return the result."""
 
@@ -418,151 +1721,1057 @@ def invoke_bedrock_flow(client_runtime, result_flow, input_content):
                     "content": {"document": input_content},
                     "nodeName": "FlowInputNode",
                     "nodeOutputName": "document"
-                }]
+                }],
+                enableTrace=FLOW_TRACE == 'on'
             )
             
-            result = {}
+            result = {'flowTraceEvents': []}
             for event in response.get("responseStream"):
-                result.update(event)
+                if 'flowTraceEvent' in event:
+                    result['flowTraceEvents'].append(event['flowTraceEvent']['trace'])
+                else:
+                    result.update(event)
             
             return result
         except client_runtime.exceptions.ResourceNotFoundException as e:
-            print(f"Resource not found error: {str(e)}")
+            logger.error(f"Resource not found error: {str(e)}")
             raise
         except client_runtime.exceptions.ValidationException as e:
-            print(f"Validation error: {str(e)}")
+            logger.error(f"Validation error: {str(e)}")
             raise
         except client_runtime.exceptions.ThrottlingException as e:
-            print(f"Throttling error: {str(e)}")
+            logger.warning(f"Throttling error: {str(e)}")
             raise
         except botocore.exceptions.ClientError as e:
-            print(f"Boto3 client error: {str(e)}")
+            # Errors raised from the response stream, such as throttlingException, are retried by the caller
+            (logger.warning if get_error_code(e) in RETRYABLE_ERROR_CODES else logger.error)(f"Boto3 client error: {str(e)}")
             if e.response['Error']['Code'] == '404':
-                print("404 error: The specified flow or flow alias might not exist.")
+                logger.error("404 error: The specified flow or flow alias might not exist.")
             raise
         except Exception as e:
-            print(f"Unexpected error during flow invocation: {str(e)}")
+            logger.error(f"Unexpected error during flow invocation: {str(e)}")
             raise
         
     except json.JSONDecodeError as e:
-        print(f"Error parsing result_flow JSON: {str(e)}")
+        logger.error(f"Error parsing result_flow JSON: {str(e)}")
         raise
     except KeyError as e:
-        print(f"Missing key in result_flow: {str(e)}")
+        logger.error(f"Missing key in result_flow: {str(e)}")
         raise
-    except Exception as e:
-        print(f"Unexpected error in invoke_bedrock_flow: {str(e)}")
+
+def format_entry(entry):
+    """Format a feed entry as the flow input document."""
+    return f"Id: {entry.id} | Title: {entry.title} | Link: {entry.link} | Description: {entry.description} | Published: {entry.published}"
+
+def format_request(entry, profile, flow_type):
+    """Format the flow input document of an entry for a profile.
+
+    Only the fields the flow uses are added, so profiles that share them
+    share the request.
+    """
+    document = f"{format_entry(entry)} | Language: {profile['language']} | Audience: {profile['audience']}"
+    if flow_type == FLOW_TYPE_SCOPE:
+        document += f" | Keywords: {', '.join(profile['keywords'])}"
+    return document
+
+def has_time_budget(context):
+    """Check whether enough invocation time remains to process another entry."""
+    if context is None:
+        return True
+    return context.get_remaining_time_in_millis() > TIME_BUDGET_RESERVE_MS
+
+def translation_cache_key(flow_type, input_content):
+    """Content hash of a flow request: normalized entry text, prompt templates and model ID.
+
+    The entry ID and publication date are left out, so an announcement
+    republished under a new GUID maps to the same key.
+    """
+    text = ENTRY_VOLATILE_FIELDS.sub('', input_content)
+    text = ' '.join(HTML_TAG.sub(' ', text).split()).casefold()
+    model_id = 'local' if EXECUTION_BACKEND == 'local' else PROMPT_MODEL_ID
+    payload = json.dumps([text, model_id] + FLOW_PROMPT_TEMPLATES[flow_type])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_cached_translation(key):
+    """Look up a flow output document in the in-memory LRU, then in S3."""
+    if TRANSLATION_CACHE == 'off':
+        return None
+    with _translation_cache_lock:
+        document = _translation_cache.get(key)
+        if document is not None:
+            _translation_cache.move_to_end(key)
+            _translation_cache_stats['hits'] += 1
+            return document
+
+    if TRANSLATION_CACHE == 's3':
+        try:
+            response = get_client('s3').get_object(Bucket=BUCKET_NAME, Key=TRANSLATION_CACHE_PREFIX + key + '.json')
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                logger.warning(f"Error reading translation cache: {str(e)}")
+        else:
+            if response['LastModified'] > datetime.now(timezone.utc) - timedelta(days=TRANSLATION_CACHE_TTL_DAYS):
+                document = json.loads(response['Body'].read())['document']
+                remember_translation(key, document)
+                with _translation_cache_lock:
+                    _translation_cache_stats['hits'] += 1
+                return document
+
+    with _translation_cache_lock:
+        _translation_cache_stats['misses'] += 1
+    return None
+
+def remember_translation(key, document):
+    """Add a document to the in-memory LRU, evicting the least recently used ones."""
+    with _translation_cache_lock:
+        _translation_cache[key] = document
+        _translation_cache.move_to_end(key)
+        while len(_translation_cache) > TRANSLATION_CACHE_MAX_ITEMS:
+            _translation_cache.popitem(last=False)
+
+def cache_translation(key, document):
+    """Store a flow output document in the in-memory LRU and in S3."""
+    if TRANSLATION_CACHE == 'off':
+        return
+    remember_translation(key, document)
+    if TRANSLATION_CACHE == 's3':
+        get_client('s3').put_object(Body=json.dumps({'document': document}), Bucket=BUCKET_NAME, Key=TRANSLATION_CACHE_PREFIX + key + '.json', ContentType='application/json')
+
+def summarize_flow_trace(traces):
+    """Summarize flow trace events as the nodes run, with their duration and condition results, without their content."""
+    started = {}
+    steps = []
+    for trace in traces:
+        if 'nodeInputTrace' in trace:
+            started.setdefault(trace['nodeInputTrace']['nodeName'], trace['nodeInputTrace'].get('timestamp'))
+        elif 'nodeOutputTrace' in trace:
+            node_name = trace['nodeOutputTrace']['nodeName']
+            started_at, ended_at = started.get(node_name), trace['nodeOutputTrace'].get('timestamp')
+            steps.append(f"{node_name} ({(ended_at - started_at).total_seconds() * 1000:.0f} ms)" if started_at and ended_at else node_name)
+        elif 'conditionNodeResultTrace' in trace:
+            conditions = [condition['conditionName'] for condition in trace['conditionNodeResultTrace'].get('satisfiedConditions', [])]
+            steps.append(f"{trace['conditionNodeResultTrace']['nodeName']} [{', '.join(conditions)}]")
+    return ' -> '.join(steps)
+
+def invoke_flow_backend(flows, flow_type, documents):
+    """Run each document through the Bedrock prompt flow of its type.
+
+    A flow that completes without an output event judged the item out of the
+    scope, which gets an empty document like in the converse backend.
+    """
+    client_runtime = get_client('bedrock-agent-runtime')
+    outputs = []
+    for document in documents:
+        result = invoke_bedrock_flow(client_runtime, flows[flow_type], document)
+        if result['flowTraceEvents']:
+            logger.info(f"Flow trace: {summarize_flow_trace(result['flowTraceEvents'])}")
+        logger.debug(f"Flow output: {redact(result.get('flowOutputEvent', {}).get('content', {}).get('document', ''))}")
+        if result['flowCompletionEvent']['completionReason'] != 'SUCCESS':
+            logger.warning(f"The prompt flow invocation completed because of the following reason: {result['flowCompletionEvent']['completionReason']}")
+            outputs.append(None)
+            continue
+        # An item out of the scope takes the unconnected default branch, so the flow completes without output
+        outputs.append(result.get('flowOutputEvent', {}).get('content', {}).get('document', ''))
+    return outputs
+
+def build_batch_prompt(flow_type, documents):
+    """Build one prompt applying the prompts of a flow type to several documents."""
+    prompts = [PROMPT_INPUT_SECTION.sub('', template) for template in FLOW_PROMPT_TEMPLATES[flow_type]]
+    if len(prompts) == 1:
+        task = prompts[0]
+    else:
+        # Same chain as the flow: scope first, then the RSS item only for items in the scope
+        task = f"Step 1:\n{prompts[0]}\n\nStep 2, only for the items categorized InTheScope, the others produce no item:\n{prompts[1]}"
+    news = '\n'.join(f'<news index="{index}">\n{saxutils.escape(document)}\n</news>' for index, document in enumerate(documents))
+    return BATCH_PROMPT_TEMPLATE.format(task=task, news=news)
+
+def invoke_converse_backend(flows, flow_type, documents):
+    """Summarize several documents in one streamed Converse request with structured per-item output.
+
+    An item judged out of the scope gets an empty document, so the decision
+    is cached like a summary.
+    """
+    client = get_client('bedrock-runtime')
+    response = client.converse_stream(
+        modelId=PROMPT_MODEL_ID,
+        messages=[{'role': 'user', 'content': [{'text': build_batch_prompt(flow_type, documents)}]}],
+        inferenceConfig={'temperature': 0.8, 'maxTokens': CONVERSE_MAX_TOKENS},
+        toolConfig={
+            'tools': [{'toolSpec': {'name': 'rss_items', 'description': 'Record the RSS item of each news item.', 'inputSchema': {'json': BATCH_OUTPUT_SCHEMA}}}],
+            'toolChoice': {'tool': {'name': 'rss_items'}}
+        }
+    )
+
+    tool_input = []
+    stop_reason = None
+    for event in response['stream']:
+        if 'contentBlockDelta' in event:
+            tool_input.append(event['contentBlockDelta']['delta'].get('toolUse', {}).get('input', ''))
+        elif 'messageStop' in event:
+            stop_reason = event['messageStop'].get('stopReason')
+        elif 'metadata' in event:
+            usage = event['metadata'].get('usage', {})
+            record_token_usage(usage.get('inputTokens'), usage.get('outputTokens'))
+            logger.info(f"Converse: {len(documents)} items, {usage.get('inputTokens')} input tokens, {usage.get('outputTokens')} output tokens, {event['metadata'].get('metrics', {}).get('latencyMs')} ms")
+    if stop_reason != 'tool_use':
+        raise ValueError(f"Converse stopped without the rss_items tool call: {stop_reason}")
+
+    results = {result['index']: result['item'] for result in json.loads(''.join(tool_input))['items']}
+    missing = [index for index in range(len(documents)) if index not in results]
+    if missing:
+        raise ValueError(f"Converse returned no result for items {missing}")
+    return [results[index] or '' for index in range(len(documents))]
+
+def invoke_local_backend(flows, flow_type, documents):
+    """Offline stand-in for the model: echo each entry as an RSS item, without any AWS call."""
+    outputs = []
+    for document in documents:
+        fields = dict(field.split(': ', 1) for field in document.split(' | ') if ': ' in field)
+        language = STUB_LANGUAGE.search(document + ' | ')
+        title = f"[{language.group(1) if language else 'stub'}] {fields.get('Title', '')}"
+        description = ' '.join(HTML_TAG.sub(' ', fields.get('Description', '')).split()[:150])
+        outputs.append(
+            f"<item><guid>{hashlib.sha256(document.encode('utf-8')).hexdigest()[:16]}</guid>"
+            f"<title>{saxutils.escape(title)}</title><link>{saxutils.escape(fields.get('Link', ''))}</link>"
+            f"<description>{saxutils.escape(description)}</description></item>"
+        )
+    return outputs
+
+EXECUTION_BACKENDS = {
+    'flow': invoke_flow_backend,
+    'converse': invoke_converse_backend,
+    'local': invoke_local_backend
+}
+BACKEND_BATCH_SIZES = {
+    'flow': 1,
+    'converse': CONVERSE_BATCH_SIZE,
+    'local': CONVERSE_BATCH_SIZE
+}
+
+def parse_item(document):
+    """Parse a backend output document into a feed entry, or None when it holds no item.
+
+    Raises ValueError for a non-empty document that is not an RSS item, such
+    as a refusal or prose.
+    """
+    if not document:
+        return None
+    entries = parse_feed(document).entries
+    if not entries:
+        raise ValueError(f"Backend output is not an RSS item: {redact(document)}")
+    return entries[0]
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limiter for in-flight flow invocations.
+
+    The limit grows by one slot per window of successful calls and is halved
+    when Bedrock throttles, between 1 and max_limit.
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+            logger.warning(f"Bedrock throttled, concurrency limit reduced to {int(self.limit)}")
+
+def get_error_code(error):
+    """Return the AWS error code of a ClientError, or None.
+
+    Errors raised from an event stream (InvokeFlow, ConverseStream) carry the
+    stream member name, such as throttlingException, so the first letter is
+    capitalized to match the error codes of the API.
+    """
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        return code[:1].upper() + code[1:] if code else code
+    return None
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def process_batch_with_retry(flows, flow_type, documents, entry_ids, limiter, context):
+    """Run a batch of documents through the execution backend, retrying throttled and transient errors with backoff."""
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            with timed_stage('ModelInvoke'):
+                outputs = EXECUTION_BACKENDS[EXECUTION_BACKEND](flows, flow_type, documents)
+        except Exception as e:
+            code = get_error_code(e)
+            add_metric('ModelErrors')
+            if code in THROTTLING_ERROR_CODES:
+                add_metric('ModelThrottles')
+                limiter.on_throttle()
+            attempt += 1
+            if code not in RETRYABLE_ERROR_CODES or attempt >= FLOW_MAX_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            if context is not None and context.get_remaining_time_in_millis() - delay * 1000 <= TIME_BUDGET_RESERVE_MS:
+                raise
+            logger.warning(f"Retrying {', '.join(entry_ids)} after {code} in {delay:.1f}s (attempt {attempt + 1}/{FLOW_MAX_ATTEMPTS})")
+            add_metric('ModelRetries')
+        else:
+            limiter.on_success()
+            return outputs
+        finally:
+            limiter.release()
+        time.sleep(delay)
+
+def load_retry_queue(s3_client):
+    """Load entries left over by previous runs from the S3 retry queue.
+
+    Returns the entries to retry and the IDs of the entries given up on, with
+    the time they were abandoned.
+    """
+    try:
+        queue = json.loads(get_s3_object(s3_client, KEY_RETRY_QUEUE_NAME))
+    except ClientError as e:
+        if get_error_code(e) in ('NoSuchKey', '404'):
+            return [], {}
         raise
+    return [feedparser.FeedParserDict(record) for record in queue.get('entries', [])], queue.get('abandoned', {})
+
+def entry_record(entry):
+    """Serializable copy of the fields of an entry the pipeline uses."""
+    return {
+        'id': entry.id,
+        'title': entry.get('title'),
+        'link': entry.get('link'),
+        'description': entry.get('description'),
+        'published': format_entry_date(entry),
+        'source_feed': entry.get('source_feed')
+    }
+
+def save_retry_queue(s3_client, entries, attempted_ids, abandoned, abandon=()):
+    """Persist entries to retry on the next run to the S3 retry queue.
+
+    Entries still failing after RETRY_QUEUE_MAX_RUNS runs, and the IDs in
+    abandon (given up by the queue mode), are added to abandoned, which
+    dedup consults so the upstream feed does not bring them back as new.
+    Abandoned IDs are forgotten after RETRY_QUEUE_ABANDONED_DAYS, once the
+    entries have left the upstream feed. Returns the abandoned IDs.
+    """
+    now = time.time()
+    abandoned = {entry_id: abandoned_at for entry_id, abandoned_at in abandoned.items() if abandoned_at > now - RETRY_QUEUE_ABANDONED_DAYS * 86400}
+    abandoned.update((entry_id, now) for entry_id in abandon)
+    records = []
+    for entry in entries:
+        if entry.id in abandoned:
+            continue
+        runs = entry.get('retry_runs', 0) + (1 if entry.id in attempted_ids else 0)
+        if runs > RETRY_QUEUE_MAX_RUNS:
+            logger.warning(f"Abandoning {entry.id} after {RETRY_QUEUE_MAX_RUNS} runs")
+            abandoned[entry.id] = now
+            continue
+        records.append(dict(entry_record(entry), retry_runs=runs))
+    s3_client.put_object(Body=json.dumps({'entries': records, 'abandoned': abandoned}), Bucket=BUCKET_NAME, Key=KEY_RETRY_QUEUE_NAME, ContentType='application/json')
+    return abandoned
+
+def process_entries(flows, requests, context):
+    """Run (entry, flow_type, document) requests through the execution backend concurrently.
+
+    Outputs are cached by content, so reruns and republished entries do not
+    call the model again. The remaining requests are sent in batches of the
+    backend's size, one per flow type. Results are returned in the order of
+    requests, one per request, with a status of SUCCESS, FAILED or SKIPPED
+    (time budget exhausted before its batch started).
+    """
+    limiter = AdaptiveConcurrencyLimiter(FLOW_CONCURRENCY)
+    results = [None] * len(requests)
+
+    def lookup(request):
+        entry, flow_type, document = request
+        logger.debug(f"Request for {entry.id}: {redact(document)}")
+        key = translation_cache_key(flow_type, document)
+        return key, get_cached_translation(key)
+
+    def run(batch):
+        flow_type, positions = batch
+        entries = [requests[position][0] for position in positions]
+        if not has_time_budget(context):
+            return [{'entry': entry, 'status': 'SKIPPED', 'item': None, 'error': None} for entry in entries]
+        try:
+            outputs = process_batch_with_retry(flows, flow_type, [requests[position][2] for position in positions], [entry.id for entry in entries], limiter, context)
+        except Exception as e:
+            logger.error(f"Error invoking the {EXECUTION_BACKEND} backend for {', '.join(entry.id for entry in entries)}: {str(e)}")
+            return [{'entry': entry, 'status': 'FAILED', 'item': None, 'error': e} for entry in entries]
+        batch_results = []
+        for entry, position, output in zip(entries, positions, outputs):
+            try:
+                item = parse_item(output)
+            except ValueError as e:
+                logger.warning(f"Invalid output of the {EXECUTION_BACKEND} backend for {entry.id}: {str(e)}")
+                batch_results.append({'entry': entry, 'status': 'FAILED', 'item': None, 'error': e})
+                continue
+            # Only outputs that parsed are cached, so a malformed completion is asked again
+            if output is not None:
+                cache_translation(keys[position], output)
+            batch_results.append({'entry': entry, 'status': 'SUCCESS', 'item': item, 'error': None})
+        return batch_results
+
+    with ThreadPoolExecutor(max_workers=max(1, FLOW_CONCURRENCY)) as executor:
+        keys = []
+        pending = {}
+        for position, (key, cached) in enumerate(executor.map(lookup, requests)):
+            keys.append(key)
+            entry, flow_type, document = requests[position]
+            if cached is not None:
+                try:
+                    results[position] = {'entry': entry, 'status': 'SUCCESS', 'item': parse_item(cached), 'error': None}
+                    logger.debug(f"Using cached output for {entry.id}")
+                    continue
+                except ValueError as e:
+                    logger.warning(f"Ignoring cached output for {entry.id}: {str(e)}")
+            pending.setdefault(flow_type, []).append(position)
+
+        size = max(1, BACKEND_BATCH_SIZES[EXECUTION_BACKEND])
+        batches = [(flow_type, positions[start:start + size]) for flow_type, positions in pending.items() for start in range(0, len(positions), size)]
+        for batch, batch_results in zip(batches, executor.map(run, batches)):
+            for position, result in zip(batch[1], batch_results):
+                results[position] = result
+    return results
+
+def iter_feed_history(s3_client, key, since=None):
+    """Stream the entries of a feed and of its archive segments, following the prev-archive links.
+
+    Feeds and segments hold the newest items first, so with since (a Unix
+    timestamp) the walk stops at the first older entry.
+    """
+    seen = set()
+    base_url = get_feed_url('')
+    stopped = []
+
+    def stop(entry):
+        if since and get_entry_timestamp(entry) < since:
+            stopped.append(entry)
+        return bool(stopped)
+
+    while key and key not in seen:
+        seen.add(key)
+        try:
+            body = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body']
+        except ClientError as e:
+            if get_error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            return
+        links = {}
+        for entry in iter_feed_entries(body, links, stop):
+            yield entry
+        if stopped:
+            return
+        previous = links.get('prev-archive')
+        key = previous[len(base_url):] if previous and previous.startswith(base_url) else None
+
+def build_model_input(flow_type, document):
+    """Build the InvokeModel body of a batch inference record, with the same prompt and output as the Converse backend."""
+    return {
+        'anthropic_version': 'bedrock-2023-05-31',
+        'max_tokens': CONVERSE_MAX_TOKENS,
+        'temperature': 0.8,
+        'messages': [{'role': 'user', 'content': [{'type': 'text', 'text': build_batch_prompt(flow_type, [document])}]}],
+        'tools': [{'name': 'rss_items', 'description': 'Record the RSS item of each news item.', 'input_schema': BATCH_OUTPUT_SCHEMA}],
+        'tool_choice': {'type': 'tool', 'name': 'rss_items'}
+    }
+
+def get_model_output_document(record):
+    """Return the output document of a batch inference output record, or None when the record failed."""
+    if 'error' in record or 'modelOutput' not in record:
+        return None
+    usage = record['modelOutput'].get('usage')
+    if usage:
+        record_token_usage(usage.get('input_tokens'), usage.get('output_tokens'), BATCH_PRICE_FACTOR)
+    for block in record['modelOutput'].get('content', []):
+        if block.get('type') == 'tool_use':
+            items = block['input'].get('items', [])
+            return (items[0].get('item') or '') if items else ''
+    return None
+
+class BedrockBatchJobs:
+    """Bedrock batch inference jobs reading and writing JSONL in the bucket."""
+
+    def submit(self, name, records):
+        input_key = f"{BACKFILL_PREFIX}{name}/input.jsonl"
+        get_client('s3').put_object(Body=''.join(json.dumps(record) + '\n' for record in records), Bucket=BUCKET_NAME, Key=input_key, ContentType='application/jsonl')
+        response = get_client('bedrock').create_model_invocation_job(
+            jobName=name,
+            roleArn=BACKFILL_ROLE_ARN,
+            modelId=PROMPT_MODEL_ID,
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': f"s3://{BUCKET_NAME}/{input_key}", 's3InputFormat': 'JSONL'}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{BUCKET_NAME}/{BACKFILL_PREFIX}{name}/output/"}}
+        )
+        return response['jobArn']
+
+    def status(self, job_id):
+        return get_client('bedrock').get_model_invocation_job(jobIdentifier=job_id)['status']
+
+    def outputs(self, job_id, name):
+        # Outputs are written under <output prefix>/<job ID>/<input file name>.out
+        output_key = f"{BACKFILL_PREFIX}{name}/output/{job_id.rsplit('/', 1)[-1]}/input.jsonl.out"
+        body = get_client('s3').get_object(Bucket=BUCKET_NAME, Key=output_key)['Body']
+        for line in body.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+class LocalBatchJobs:
+    """File-based stand-in for the batch inference service, answering with the local backend."""
+
+    def submit(self, name, records):
+        job_dir = os.path.join(BACKFILL_LOCAL_DIR, name)
+        os.makedirs(job_dir, exist_ok=True)
+        with open(os.path.join(job_dir, 'input.jsonl'), 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+
+        # The job completes immediately: each prompt holds a single escaped news document
+        with open(os.path.join(job_dir, 'input.jsonl.out'), 'w') as f:
+            for record in records:
+                prompt = record['modelInput']['messages'][0]['content'][0]['text']
+                document = saxutils.unescape(prompt.split('<news index="0">\n', 1)[1].rsplit('\n</news>', 1)[0])
+                items = [{'index': 0, 'item': invoke_local_backend({}, None, [document])[0]}]
+                f.write(json.dumps(dict(record, modelOutput={'content': [{'type': 'tool_use', 'name': 'rss_items', 'input': {'items': items}}]})) + '\n')
+        return job_dir
+
+    def status(self, job_id):
+        return 'Completed' if os.path.exists(os.path.join(job_id, 'input.jsonl.out')) else 'InProgress'
+
+    def outputs(self, job_id, name):
+        with open(os.path.join(job_id, 'input.jsonl.out')) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+BACKFILL_JOB_SERVICES = {
+    'bedrock': BedrockBatchJobs,
+    'local': LocalBatchJobs
+}
+
+def submit_backfill(s3_client, secret, options):
+    """Write the requests of past entries as JSONL records and submit them as one batch inference job.
+
+    Entries come from processed.xml and its archives, optionally limited to
+    some profiles and to entries published since a date. The job and the
+    destination of each record are kept in the backfill state object.
+    """
+    profiles = load_profiles(secret)
+    if options.get('profiles'):
+        profiles = [profile for profile in profiles if profile['name'] in options['profiles']]
+    since = datetime.fromisoformat(options['since']).replace(tzinfo=timezone.utc).timestamp() if options.get('since') else None
+    entries = list(iter_feed_history(s3_client, KEY_PROCESSED_NAME, since))
+
+    requests, entry_routes = route_entries(entries, profiles)
+    destinations = [[] for _ in requests]
+    for entry, routes in zip(entries, entry_routes):
+        for profile, request_position in routes:
+            destinations[request_position].append(profile['output_key'])
+
+    records = []
+    record_states = {}
+    for position, (entry, flow_type, document) in enumerate(requests):
+        record_id = f"REC{position:08d}"
+        records.append({'recordId': record_id, 'modelInput': build_model_input(flow_type, document)})
+        record_states[record_id] = {
+            'id': entry.id,
+            'key': translation_cache_key(flow_type, document),
+            'published': format_entry_date(entry),
+            'output_keys': sorted(set(destinations[position]))
+        }
+    if not records:
+        logger.info(f"Nothing to backfill from {len(entries)} entries")
+        return None
+    if BACKFILL_JOB_SERVICE == 'bedrock' and len(records) < BACKFILL_MIN_RECORDS:
+        raise ValueError(f"Backfill has {len(records)} records, batch inference needs at least {BACKFILL_MIN_RECORDS}; let the scheduled runs process them")
+
+    name = f"awsnews-backfill-{int(time.time())}-{secrets.token_hex(2)}"
+    job_id = BACKFILL_JOB_SERVICES[BACKFILL_JOB_SERVICE]().submit(name, records)
+    state = {'job_id': job_id, 'name': name, 'service': BACKFILL_JOB_SERVICE, 'records': record_states}
+    s3_client.put_object(Body=json.dumps(state), Bucket=BUCKET_NAME, Key=KEY_BACKFILL_STATE_NAME, ContentType='application/json')
+    logger.info(f"Submitted backfill job {job_id} with {len(records)} records from {len(entries)} entries")
+    return state
+
+def merge_backfill(s3_client, state):
+    """Merge the outputs of a completed backfill job into the profile feeds, in publication order."""
+    items = {}
+    failed = 0
+    for record in BACKFILL_JOB_SERVICES[state['service']]().outputs(state['job_id'], state['name']):
+        record_state = state['records'].get(record.get('recordId'))
+        if record_state is None:
+            continue
+        document = get_model_output_document(record)
+        if document is None:
+            failed += 1
+            continue
+        try:
+            item = parse_item(document)
+        except ValueError as e:
+            logger.warning(f"Backfill record {record['recordId']}: {str(e)}")
+            failed += 1
+            continue
+        cache_translation(record_state['key'], document)
+        if item is None:
+            continue
+        # The upstream ID is the guid, as for the scheduled runs, so merging the same backfill again adds nothing
+        item['id'] = record_state.get('id', item.get('id'))
+        published = parse_date(record_state['published']) or datetime.now(timezone.utc)
+        for output_key in record_state['output_keys']:
+            items.setdefault(output_key, []).append(create_rss_item(item, published))
+
+    for output_key, output_items in items.items():
+        prepend_feed_items(s3_client, output_key, output_items, merge=True)
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key=KEY_BACKFILL_STATE_NAME)
+    added = sum(len(output_items) for output_items in items.values())
+    logger.info(f"Backfill job {state['job_id']}: {added} items merged, {failed} records failed")
+    return added, failed
+
+def run_backfill(s3_client, secret, options, context):
+    """Submit a backfill job if none is running, then poll it until it completes or the time budget runs out."""
+    try:
+        state = json.loads(get_s3_object(s3_client, KEY_BACKFILL_STATE_NAME))
+    except ClientError as e:
+        if get_error_code(e) not in ('NoSuchKey', '404'):
+            raise
+        state = submit_backfill(s3_client, secret, options)
+        if state is None:
+            return {'job': None, 'status': 'Empty', 'added': 0, 'failed': 0}
+
+    jobs = BACKFILL_JOB_SERVICES[state['service']]()
+    while True:
+        status = jobs.status(state['job_id'])
+        if status not in BACKFILL_RUNNING_STATUSES:
+            break
+        if context is not None and context.get_remaining_time_in_millis() - BACKFILL_POLL_INTERVAL * 1000 <= TIME_BUDGET_RESERVE_MS:
+            logger.info(f"Backfill job {state['job_id']} is {status}, polling again on the next backfill invocation")
+            return {'job': state['job_id'], 'status': status}
+        time.sleep(BACKFILL_POLL_INTERVAL)
+
+    if status not in ('Completed', 'PartiallyCompleted'):
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=KEY_BACKFILL_STATE_NAME)
+        raise RuntimeError(f"Backfill job {state['job_id']} ended with status {status}")
+    added, failed = merge_backfill(s3_client, state)
+    return {'job': state['job_id'], 'status': status, 'added': added, 'failed': failed}
+
+def resolve_flows(s3_client, flow_types):
+    """Resolve the flows of the given types, from the cache when possible."""
+    flows = {}
+    if EXECUTION_BACKEND != 'flow':
+        return flows
+    for flow_type in flow_types:
+        with timed_stage('FlowResolution'):
+            result_flow = get_cached_flow(s3_client, flow_type)
+            if result_flow is None:
+                # Create a Bedrock client
+                client = get_client('bedrock-agent')
+                result_flow = resolve_flow(client, flow_type)
+                cache_flow(s3_client, result_flow, flow_type)
+        flows[flow_type] = result_flow
+    return flows
+
+def collect_entry_results(entries, entry_routes, request_results, profiles):
+    """Combine the results of the requests of each entry.
+
+    An entry is processed once the requests of all its profiles succeeded.
+    Returns the per-entry results and the new items of each output feed.
+    """
+    results = []
+    new_items = {profile['output_key']: [] for profile in profiles}
+    for entry, routes in zip(entries, entry_routes):
+        statuses = set(request_results[request_position]['status'] for _, request_position in routes)
+        status = 'FAILED' if 'FAILED' in statuses else 'SKIPPED' if 'SKIPPED' in statuses else 'SUCCESS'
+        error = next((request_results[request_position]['error'] for _, request_position in routes if request_results[request_position]['error'] is not None), None)
+        results.append({'entry': entry, 'status': status, 'error': error, 'items': {}})
+        if status == 'SUCCESS':
+            for profile, request_position in routes:
+                item = request_results[request_position]['item']
+                if item is not None:
+                    # The upstream ID identifies the item, so a commit applied twice adds it once
+                    item['id'] = entry.id
+                    new_items[profile['output_key']].append(item)
+                    results[-1]['items'].setdefault(profile['output_key'], []).append(item)
+    return results, new_items
+
+class LocalQueues:
+    """In-memory stand-in for SQS, shared by the handlers of this execution environment."""
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with _local_queues_lock:
+            queue = _local_queues.setdefault(QueueUrl, {'messages': deque(), 'dead_letters': []})
+            queue['messages'].extend({'messageId': secrets.token_hex(8), 'body': entry['MessageBody'], 'receive_count': 0} for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def receive(self, queue_url, max_messages):
+        """Take up to max_messages messages off a queue, as SQS event records."""
+        with _local_queues_lock:
+            messages = _local_queues.get(queue_url, {'messages': deque()})['messages']
+            received = [messages.popleft() for _ in range(min(max_messages, len(messages)))]
+        for message in received:
+            message['receive_count'] += 1
+        return received
+
+    def release(self, queue_url, messages):
+        """Return failed messages to their queue, or move them to its dead letters after QUEUE_MAX_RECEIVES deliveries."""
+        with _local_queues_lock:
+            queue = _local_queues[queue_url]
+            for message in messages:
+                if message['receive_count'] >= QUEUE_MAX_RECEIVES:
+                    logger.warning(f"Moving message {message['messageId']} of {queue_url} to the dead letters after {message['receive_count']} deliveries")
+                    queue['dead_letters'].append(message)
+                else:
+                    queue['messages'].append(message)
+
+QUEUE_SERVICES = {
+    'sqs': lambda: get_client('sqs'),
+    'local': LocalQueues
+}
+
+def send_messages(queue_url, bodies, group_id=None):
+    """Send message bodies to a queue in batches, raising if any of them is rejected."""
+    client = QUEUE_SERVICES[QUEUE_SERVICE]()
+    for start in range(0, len(bodies), QUEUE_SEND_BATCH_SIZE):
+        entries = [{'Id': str(position), 'MessageBody': body} for position, body in enumerate(bodies[start:start + QUEUE_SEND_BATCH_SIZE])]
+        if group_id:
+            for entry in entries:
+                entry['MessageGroupId'] = group_id
+        response = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        if response.get('Failed'):
+            raise RuntimeError(f"{len(response['Failed'])} messages rejected by {queue_url}: {response['Failed'][0].get('Message')}")
+
+def load_queue_state(s3_client, processed_index):
+    """Load the entries handed to the workers and not processed yet, with the time they were enqueued and their feed.
+
+    Returns the pending entries and the entries whose pending state expired.
+    """
+    try:
+        pending = json.loads(get_s3_object(s3_client, KEY_QUEUE_STATE_NAME)).get('pending', {})
+    except ClientError as e:
+        if get_error_code(e) not in ('NoSuchKey', '404'):
+            raise
+        return {}, {}
+    # States written before the feed was recorded hold only the time
+    pending = {entry_id: state if isinstance(state, dict) else {'enqueued_at': state, 'source_feed': None} for entry_id, state in pending.items()}
+    # Entries still pending after the TTL were lost (dead letters), so they are enqueued again
+    expired_before = time.time() - QUEUE_PENDING_TTL_SECONDS
+    pending = {entry_id: state for entry_id, state in pending.items() if not index_contains(processed_index, entry_id)}
+    expired = {entry_id: state for entry_id, state in pending.items() if state['enqueued_at'] <= expired_before}
+    return {entry_id: state for entry_id, state in pending.items() if entry_id not in expired}, expired
+
+def get_queue_pending_urls(queue_state, feeds):
+    """Feeds with entries still in the queue, whose validators are not kept.
+
+    Otherwise an unchanged feed answers 304 and an entry lost to the dead
+    letters is never seen again once its pending state expires.
+    """
+    pending_urls = set(state['source_feed'] for state in queue_state.values())
+    return set(feeds) if None in pending_urls else pending_urls
+
+def save_queue_state(s3_client, pending):
+    s3_client.put_object(Body=json.dumps({'pending': pending}), Bucket=BUCKET_NAME, Key=KEY_QUEUE_STATE_NAME, ContentType='application/json')
+
+def enqueue_entries(entries, signatures, duplicates):
+    """Send one message per entry to the entry queue, with its SimHash signature and near-duplicate flag."""
+    bodies = [json.dumps({
+        'entry': entry_record(entry),
+        # The signature of a duplicate is not indexed, its original stands for it
+        'signature': signatures[position] if signatures and position not in duplicates else None,
+        'duplicate': position in duplicates
+    }) for position, entry in enumerate(entries)]
+    send_messages(ENTRY_QUEUE_URL, bodies)
+
+def process_entry_messages(records, context):
+    """Process entry messages and send the results of the processed entries to the result queue.
+
+    Returns the IDs of the messages whose entry failed or ran out of time.
+    """
+    s3 = get_client('s3')
+    profiles = load_profiles(get_secret(os.environ['FEED_URL_SECRET_NAME']))
+    messages = [json.loads(record['body']) for record in records]
+    entries = [feedparser.FeedParserDict(message['entry']) for message in messages]
+    duplicates = set(position for position, message in enumerate(messages) if message.get('duplicate'))
+
+    with timed_stage('Scoping'):
+        requests, entry_routes = route_entries(entries, profiles, duplicates)
+    request_results = process_entries(resolve_flows(s3, set(request[1] for request in requests)), requests, context)
+    results, _ = collect_entry_results(entries, entry_routes, request_results, profiles)
+    if any(get_error_code(result['error']) == 'ResourceNotFoundException' for result in results):
+        invalidate_flow_cache(s3)
+
+    now = datetime.now(timezone.utc)
+    bodies = []
+    with timed_stage('Render'):
+        for message, result in zip(messages, results):
+            if result['status'] != 'SUCCESS':
+                continue
+            feeds = {key: [render_rss_items([create_rss_item(item, now)]).decode('utf-8') for item in items] for key, items in result['items'].items()}
+            feeds[KEY_PROCESSED_NAME] = [render_rss_items([create_rss_item(result['entry'], now)]).decode('utf-8')]
+            bodies.append(json.dumps({'id': result['entry'].id, 'signature': message.get('signature'), 'feeds': feeds}))
+    with timed_stage('Enqueue'):
+        send_messages(RESULT_QUEUE_URL, bodies, group_id='results')
+
+    failed = [record['messageId'] for record, result in zip(records, results) if result['status'] != 'SUCCESS']
+    logger.info(f"Worker processed {len(bodies)} of {len(records)} entries, {len(failed)} left for redelivery")
+    add_metric('ProcessedEntries', len(bodies))
+    add_metric('FailedEntries', len(failed))
+    return failed
+
+def commit_result_messages(records):
+    """Commit the results of a batch of result messages to the feeds and indexes in one journaled commit."""
+    s3 = get_client('s3')
+    results = [json.loads(record['body']) for record in records]
+    feed_items = {}
+    for result in results:
+        for key, items in result['feeds'].items():
+            feed_items.setdefault(key, []).extend(item.encode('utf-8') for item in items)
+    with timed_stage('Commit'):
+        recover_commits(s3)
+        run_id = f"{int(time.time() * 1000)}-{secrets.token_hex(4)}"
+        journal = stage_commit(s3, run_id, feed_items, sorted(set(result['id'] for result in results)), [result['signature'] for result in results if result.get('signature') is not None])
+        apply_commit(s3, journal)
+    added = sum(len(items) for key, items in feed_items.items() if key != KEY_PROCESSED_NAME)
+    logger.info(f"Committed {len(results)} entries, {added} added to the feeds")
+    add_metric('AddedItems', added)
+
+def drain_local_queues(context):
+    """Deliver the local queues to the workers, then to the aggregator, until they are empty or the time budget runs out."""
+    queues = LocalQueues()
+    while has_time_budget(context):
+        batches = [batch for batch in (queues.receive(ENTRY_QUEUE_URL, QUEUE_BATCH_SIZE) for _ in range(QUEUE_LOCAL_WORKERS)) if batch]
+        if batches:
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                for batch, failed in zip(batches, executor.map(lambda batch: process_entry_messages(batch, context), batches)):
+                    queues.release(ENTRY_QUEUE_URL, [message for message in batch if message['messageId'] in failed])
+        results = queues.receive(RESULT_QUEUE_URL, QUEUE_SEND_BATCH_SIZE)
+        if results:
+            commit_result_messages(results)
+        elif not batches:
+            return
+
+def worker_handler(event, context):
+    """Entry queue consumer: process a batch of entries, reporting the failed ones as batch item failures for redelivery."""
+    reset_metrics()
+    try:
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in process_entry_messages(event['Records'], context)]}
+    finally:
+        emit_metrics()
+
+def aggregator_handler(event, context):
+    """Result queue consumer: merge the results of the workers into the feeds.
+
+    The result queue is FIFO with a single message group, so one batch is
+    committed at a time.
+    """
+    reset_metrics()
+    try:
+        commit_result_messages(event['Records'])
+    finally:
+        invalidate_changed_feeds()
+        emit_metrics()
 
 def lambda_handler(event, context):
+    global _cold_start
+    if _cold_start:
+        logger.info(f"Cold start: module initialised in {_INIT_DURATION_MS:.0f} ms")
+        _cold_start = False
     try:
-        s3 = boto3.client('s3')
+        started_at = time.perf_counter()
+        _translation_cache_stats.update(hits=0, misses=0)
+        reset_metrics()
+        s3 = get_client('s3')
         
-        # Retrieve FEED_URL from Secrets Manager
+        # Retrieve the feed URLs from Secrets Manager
         secret_name = os.environ['FEED_URL_SECRET_NAME']
         secret = get_secret(secret_name)
-        FEED_URL = secret['FEED_URL']
+        feed_urls = get_feed_urls(secret)
+        logger.info(f"Invocation setup took {(time.perf_counter() - started_at) * 1000:.0f} ms")
 
-        # Process existing feeds
-        rss_content = get_s3_object(s3, KEY_NAME)
-        existing_feed = parse_feed(rss_content)
-        existing_ids = get_existing_ids(existing_feed)
-        
-        rss_processed_content = get_s3_object(s3, KEY_PROCESSED_NAME)
-        existing_processed_feed = parse_feed(rss_processed_content)
-        existing_processed_ids = get_existing_ids(existing_processed_feed)
+        # Backfills of past entries run as batch inference jobs, outside the scheduled flow
+        if isinstance(event, dict) and 'backfill' in event:
+            return {
+                'statusCode': 200,
+                'body': json.dumps(run_backfill(s3, secret, event['backfill'] or {}, context))
+            }
+
+        # Fetch the upstream feeds, skipping the run when none of them changed
+        with timed_stage('StateRead'):
+            feed_states = load_feed_states(s3)
+        feeds = fetch_feeds(feed_urls, feed_states)
+        if all(feed is not None and feed.get('status') == 304 for feed in feeds.values()):
+            logger.info("Upstream feeds not modified since the last run")
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Feed not modified.')
+            }
+        upstream_entries = merge_feed_entries(feeds)
+
+        # Finish the commits of interrupted runs, then load the index of processed entry IDs
+        with timed_stage('Commit'):
+            recover_commits(s3)
+        with timed_stage('StateRead'):
+            processed_index = load_processed_index(s3)
+            queued_retries, abandoned = load_retry_queue(s3)
         
-        # Process new feed
-        feed = feedparser.parse(FEED_URL)
+        # Entries that failed in previous runs go first, then the new upstream entries
+        with timed_stage('Dedup'):
+            retry_entries = [entry for entry in queued_retries if not index_contains(processed_index, entry.id)]
+            retry_ids = set(entry.id for entry in retry_entries)
+            new_entries = retry_entries + [entry for entry in upstream_entries if not index_contains(processed_index, entry.id) and entry.id not in retry_ids and entry.id not in abandoned]
         
-        new_entries = [entry for entry in feed.entries if entry.id not in existing_processed_ids]
+        # Entries already handed to the workers are not enqueued again
+        if PIPELINE_MODE == 'queue':
+            with timed_stage('StateRead'):
+                queue_state, expired = load_queue_state(s3, processed_index)
+            # Entries lost to the dead letters are enqueued again up to QUEUE_MAX_ENQUEUES times, then given up
+            given_up = set(entry_id for entry_id, state in expired.items() if state.get('enqueues', 1) >= QUEUE_MAX_ENQUEUES)
+            if given_up:
+                for entry_id in sorted(given_up):
+                    logger.warning(f"Abandoning {entry_id} after {QUEUE_MAX_ENQUEUES} enqueues")
+                with timed_stage('StateWrite'):
+                    abandoned = save_retry_queue(s3, queued_retries, set(), abandoned, given_up)
+                    save_queue_state(s3, dict(queue_state, **{entry_id: state for entry_id, state in expired.items() if entry_id not in given_up}))
+            new_entries = [entry for entry in new_entries if entry.id not in queue_state and entry.id not in given_up]
+            # Enqueued again, so they are not checked against the index a second time
+            retry_ids = retry_ids | set(expired)
         
-        print(str(new_entries))
+        logger.info(f"{len(new_entries)} new entries, {len(retry_entries)} of them from the retry queue")
+        add_metric('NewEntries', len(new_entries))
         
         if not new_entries:
+            with timed_stage('StateWrite'):
+                save_feed_states(s3, update_feed_states(feed_states, feeds, get_queue_pending_urls(queue_state, feeds) if PIPELINE_MODE == 'queue' else set()))
             return {
                 'statusCode': 200,
                 'body': json.dumps('No new entries found.')
             }
         
-        last_entry = new_entries[0]
-        recent_updates = f"Id: {last_entry.id} | Title: {last_entry.title} | Link: {last_entry.link} | Description: {last_entry.description} | Published: {last_entry.published}"
+        batch = new_entries if PIPELINE_MODE == 'queue' else new_entries[:MAX_ENTRIES_PER_RUN]
+        profiles = load_profiles(secret)
 
-        print(recent_updates)
-        
-        # Update processed feed
-        rss_processed_items = [create_rss_item(last_entry, datetime.now())] + [create_rss_item(entry) for entry in existing_processed_feed.entries]
-        rss_processed_feed = create_rss_feed(rss_processed_items)
-        s3.put_object(Body=rss_processed_feed.to_xml("UTF-8"), Bucket=BUCKET_NAME, Key=KEY_PROCESSED_NAME)
-        
-        # Invoke Bedrock flow
-        client_runtime = boto3.client('bedrock-agent-runtime')
-        
-        # Create a Bedrock client
-        client = boto3.client(service_name='bedrock-agent')
-
-        # Check for existing flows starting with "AWSNews_"
-        flows_response = client.list_flows()
-        flows = flows_response.get('flowSummaries', [])
-        existing_flow = next((flow for flow in flows if flow['name'].startswith('AWSNews_')), None)
-
-        if existing_flow:
-            # Use the existing flow
-            flow_id = existing_flow['id']
-            flow_aliases_response = client.list_flow_aliases(flowIdentifier=flow_id)
-            flow_aliases = flow_aliases_response.get('flowAliasSummaries', [])
-            flow_alias_id = next((alias['id'] for alias in flow_aliases if alias['name'] == 'latest'), None)
-
-            if not flow_alias_id:
-                # Create a new alias if 'latest' doesn't exist
-                response = client.create_flow_alias(
-                    flowIdentifier=flow_id,
-                    name="latest",
-                    description="Alias pointing to the latest version of the flow.",
-                    routingConfiguration=[
-                        {
-                            "flowVersion": client.get_flow(flowIdentifier=flow_id)['latestVersion']
-                        }
-                    ]
-                )
-                flow_alias_id = response.get("id")
-
-            result_flow = {
-                "statusCode": 200,
-                "body": json.dumps({
-                    "flowId": flow_id,
-                    "flow_alias_Id": flow_alias_id,
-                    "message": "Existing flow retrieved successfully"
-                })
+        # Collapse near-duplicates of already processed or earlier entries.
+        # Duplicates never add their signature to the index, so an original
+        # that failed is not taken for a duplicate of its own duplicate.
+        signatures = []
+        duplicates = set()
+        duplicate_of = {}
+        if NEAR_DUPLICATE_FILTER != 'off':
+            with timed_stage('StateRead'):
+                near_duplicate_index = load_near_duplicate_index(s3)
+            with timed_stage('Dedup'):
+                for position, entry in enumerate(batch):
+                    signature = entry_simhash(entry)
+                    # Retry entries were checked against the index when first seen
+                    duplicate = None if entry.id in retry_ids else find_near_duplicate(near_duplicate_index, signature)
+                    if duplicate is None:
+                        original = next((previous for previous, previous_signature in enumerate(signatures) if bin(previous_signature ^ signature).count('1') <= NEAR_DUPLICATE_DISTANCE), None)
+                        if original is not None:
+                            duplicate = signatures[original]
+                            duplicate_of[position] = duplicate_of.get(original, original)
+                    if duplicate is not None:
+                        logger.info(f"Skipping {entry.id}, near-duplicate of signature {duplicate:016x}")
+                        duplicates.add(position)
+                    signatures.append(signature)
+
+        # In queue mode the entries go to the workers, which scale out with the backlog
+        if PIPELINE_MODE == 'queue':
+            # Resolved once here and cached, so concurrent workers do not race to create the flows
+            resolve_flows(s3, FLOW_PROMPT_TEMPLATES)
+            with timed_stage('Enqueue'):
+                enqueue_entries(batch, signatures, duplicates)
+            now = time.time()
+            queue_state.update((entry.id, {'enqueued_at': now, 'source_feed': entry.get('source_feed'), 'enqueues': expired.get(entry.id, {}).get('enqueues', 0) + 1}) for entry in batch)
+            with timed_stage('StateWrite'):
+                save_queue_state(s3, queue_state)
+                save_feed_states(s3, update_feed_states(feed_states, feeds, get_queue_pending_urls(queue_state, feeds)))
+            logger.info(f"Enqueued {len(batch)} entries")
+            if QUEUE_SERVICE == 'local':
+                drain_local_queues(context)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'Entries enqueued.', 'enqueued': len(batch)})
             }
-            print(f"Using existing flow: {existing_flow['name']}")
-        else:
-            # Create a new flow
-            result_flow = create_prompt_flow(client)
 
-        print("result_flow: " + str(result_flow))    
+        # Scope entries locally for all profiles in one pass, so only in-scope
+        # and ambiguous items reach Bedrock, and identical requests are sent once
+        with timed_stage('Scoping'):
+            requests, entry_routes = route_entries(batch, profiles, duplicates)
+
+        # Process as many new entries as the per-run cap and time budget allow
+        request_results = process_entries(resolve_flows(s3, set(request[1] for request in requests)), requests, context)
+        results, new_items = collect_entry_results(batch, entry_routes, request_results, profiles)
+        # A near-duplicate of an entry of this run stays pending until its original is processed
+        for position, original in duplicate_of.items():
+            if results[original]['status'] != 'SUCCESS':
+                results[position]['status'] = 'SKIPPED'
+        processed_entries = [result['entry'] for result in results if result['status'] == 'SUCCESS']
+        added = sum(len(items) for items in new_items.values())
+        failed_ids = [result['entry'].id for result in results if result['status'] == 'FAILED']
+        if any(get_error_code(result['error']) == 'ResourceNotFoundException' for result in results):
+            invalidate_flow_cache(s3)
+        attempted_ids = set(result['entry'].id for result in results if result['status'] != 'SKIPPED')
+        queued_entries = [result['entry'] for result in results if result['status'] == 'FAILED'] + [entry for entry in retry_entries if entry.id not in attempted_ids]
+
+        # Stage the results in the journal, then update the feeds and indexes from it
+        processed_ids = set(entry.id for entry in processed_entries)
+        if processed_ids:
+            now = datetime.now(timezone.utc)
+            with timed_stage('Render'):
+                feed_items = {output_key: [render_rss_items([create_rss_item(item, now)]) for item in items] for output_key, items in new_items.items()}
+                feed_items[KEY_PROCESSED_NAME] = [render_rss_items([create_rss_item(entry, now)]) for entry in processed_entries]
+            run_id = f"{int(time.time() * 1000)}-{secrets.token_hex(4)}"
+            with timed_stage('Commit'):
+                journal = stage_commit(s3, run_id, feed_items, sorted(processed_ids), [signature for position, (entry, signature) in enumerate(zip(batch, signatures)) if entry.id in processed_ids and position not in duplicates])
+                apply_commit(s3, journal, processed_index, near_duplicate_index if signatures else None)
+
+        with timed_stage('StateWrite'):
+            if queued_entries or retry_entries:
+                abandoned = save_retry_queue(s3, queued_entries, attempted_ids, abandoned)
+
+            # Abandoned entries no longer hold back the validators of their feed
+            pending_urls = set(entry.get('source_feed') for entry in new_entries if entry.id not in processed_ids and entry.id not in abandoned)
+            save_feed_states(s3, update_feed_states(feed_states, feeds, pending_urls))
+
+        logger.info(f"Translation cache: {_translation_cache_stats['hits']} hits, {_translation_cache_stats['misses']} misses")
+        logger.info(f"Processed {len(processed_entries)} of {len(new_entries)} new entries, {added} added to the feeds, {len(failed_ids)} failed")
+        add_metric('TranslationCacheHits', _translation_cache_stats['hits'])
+        add_metric('TranslationCacheMisses', _translation_cache_stats['misses'])
+        add_metric('ProcessedEntries', len(processed_entries))
+        add_metric('AddedItems', added)
+        add_metric('FailedEntries', len(failed_ids))
 
-        try:
-            result = invoke_bedrock_flow(client_runtime, result_flow, recent_updates)
-            print("result " +str(result))
-            if result['flowCompletionEvent']['completionReason'] == 'SUCCESS':
-                input_xml = result['flowOutputEvent']['content']['document']
-                new_feed = parse_feed(input_xml)
-                new_item = new_feed.entries[0]
-                
-                # Update main feed
-                rss_items = [create_rss_item(new_item, datetime.now())] + [create_rss_item(entry) for entry in existing_feed.entries]
-                rss_feed = create_rss_feed(rss_items)
-                s3.put_object(Body=rss_feed.to_xml("UTF-8"), Bucket=BUCKET_NAME, Key=KEY_NAME)
-            else:
-                print("The prompt flow invocation completed because of the following reason:", result['flowCompletionEvent']['completionReason'])
-        except Exception as e:
-                print(f"Error invoking Bedrock flow: {str(e)}")
-                raise    
         return {
             'statusCode': 200,
-            'body': json.dumps('RSS feed updated successfully.')
+            'body': json.dumps({
+                'message': 'RSS feed updated successfully.',
+                'processed': len(processed_entries),
+                'added': added,
+                'failed': failed_ids,
+                'remaining': len(new_entries) - len(processed_entries)
+            })
         }
     except Exception as e:
-        print(f"Unexpected error in lambda_handler: {str(e)}")
+        logger.exception(f"Unexpected error in lambda_handler: {str(e)}")
+        add_metric('Errors')
         raise
+    finally:
+        invalidate_changed_feeds()
+        emit_metrics()
+
+_INIT_DURATION_MS = (time.perf_counter() - _INIT_STARTED_AT) * 1000